@@ -0,0 +1,360 @@
+"""Benchmarks for rendering, hit-testing, export and playback scheduling.
+
+Runs headless: by default the canvases talk to a stand-in Tcl interpreter
+that only counts calls, so no display (or audio device) is needed. Pass
+--display to use a real Tk window instead, e.g. under Xvfb.
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import piano
+import fastcanvas
+from fastcanvas import FastCanvas
+from note import Note, NoteStore, notes, total_notes, lowest_note_value, notes_to_messages, export_to_midi
+from playback import PlaybackEngine
+from profiler import CountingTk
+
+
+default_sizes = [100, 1000, 10000, 100000, 1000000]
+# a run is a regression when it's this much slower than the compared run
+regression_threshold = 0.2
+
+
+class StubTk:
+    """Stands in for the Tcl interpreter, counting calls instead of drawing."""
+
+    def __init__(self):
+        self.calls = 0
+        self.item_ids = itertools.count(1)
+
+    def call(self, *args):
+        if len(args) == 1 and isinstance(args[0], tuple):
+            args = args[0]
+        self.calls += 1
+        if len(args) > 2 and args[1] == 'create':
+            return next(self.item_ids)
+        if args[:2] == ('winfo', 'width'):
+            return 800
+        if args[:2] == ('winfo', 'height'):
+            return 400
+        if len(args) > 2 and args[1] in ('canvasx', 'canvasy'):
+            return args[2]
+        return ''
+
+    def eval(self, script):
+        self.calls += 1
+        return ''
+
+    def getint(self, value):
+        return int(value)
+
+    def getdouble(self, value):
+        return float(value)
+
+    def getboolean(self, value):
+        return bool(value)
+
+    def splitlist(self, value):
+        return tuple(value) if isinstance(value, (tuple, list)) else ()
+
+    def createcommand(self, name, func):
+        pass
+
+    def deletecommand(self, name):
+        pass
+
+
+class StubRoot:
+    """Just enough of a Tk root for widgets to be created on a StubTk."""
+    _w = '.'
+
+    def __init__(self):
+        self.tk = StubTk()
+        self.children = {}
+        self._last_child_ids = None
+
+
+class StubSynth:
+    """Records when each note on and off arrives instead of playing it."""
+
+    def __init__(self):
+        self.events = []
+
+    def noteon(self, channel, value, velocity):
+        self.events.append(time.monotonic())
+
+    def noteoff(self, channel, value):
+        self.events.append(time.monotonic())
+
+    def program_change(self, channel, program):
+        pass
+
+
+def make_root(display):
+    if not display:
+        return StubRoot()
+
+    import tkinter as tk
+    root = tk.Tk()
+    root.geometry('840x400')
+    return root
+
+
+def make_widget(cls, root, **kwargs):
+    widget = cls(root, **kwargs)
+    if not isinstance(widget.tk, (StubTk, CountingTk)):
+        widget.tk = CountingTk(widget.tk)
+    if hasattr(widget, 'pack') and not isinstance(root, StubRoot):
+        widget.pack(fill='both', expand=True)
+        root.update()
+    return widget
+
+
+def dispose(widget):
+    if not isinstance(widget.tk, StubTk):
+        widget.destroy()
+
+
+def synthetic_records(n, seed=0):
+    """Returns n random notes as (start_time, end_time, value, velocity, track) records.
+
+    The notes are spread so that there's roughly the same density of notes
+    on screen whatever the size.
+    """
+    rng = random.Random(seed)
+    length = max(n * 8, 4000)
+    records = []
+    for _ in range(n):
+        start_time = rng.randrange(0, length, 20)
+        duration = rng.choice((20, 40, 40, 80, 160))
+        records.append((start_time, start_time + duration, lowest_note_value + rng.randrange(total_notes), 90, 0))
+    return records
+
+
+def timed(func, repeat=1):
+    """Returns the average time of one call, in seconds."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def bench_draw(root, records, zoom=1):
+    note_entry = make_widget(piano.NoteEntry, root, mainapp=root)
+    note_entry.add_records(records)
+    note_entry.zoom = zoom
+    note_entry.draw()
+
+    scroll_positions = [round(x * 20 / zoom) for x in range(0, 200, 7)]
+    offsets = itertools.cycle(scroll_positions)
+
+    def scroll():
+        note_entry.x_offset = next(offsets)
+        note_entry.draw()
+
+    calls = note_entry.tk.calls
+    seconds = timed(scroll, len(scroll_positions))
+    tcl_calls = (note_entry.tk.calls - calls) / len(scroll_positions)
+    dispose(note_entry)
+    return {'seconds': seconds, 'tcl_calls': tcl_calls}
+
+
+def bench_hit_test(root, records):
+    note_entry = make_widget(piano.NoteEntry, root, mainapp=root)
+    note_entry.add_records(records)
+
+    rng = random.Random(1)
+    length = max(r[1] for r in records)
+    points = [(rng.randrange(length), rng.randrange(total_notes * piano.note_height)) for _ in range(2000)]
+    started = time.perf_counter()
+    for x, y in points:
+        note_entry.is_inside_note(x, y)
+    seconds = (time.perf_counter() - started) / len(points)
+    dispose(note_entry)
+    return {'seconds': seconds}
+
+
+def bench_item_reuse(root, n_items):
+    canvas = make_widget(FastCanvas, root)
+
+    def frame(shift):
+        canvas.invalidate()
+        for i in range(n_items):
+            y = (i % 100) * 4
+            canvas.create_rectangle(shift + i % 800, y, shift + i % 800 + 10, y + 4, fill='#a8d2d7')
+        canvas.end_frame()
+
+    frame(0)
+    calls = canvas.tk.calls
+    unchanged = timed(lambda: frame(0), 5)
+    unchanged_calls = (canvas.tk.calls - calls) / 5
+    calls = canvas.tk.calls
+    shifts = itertools.count(1)
+    changed = timed(lambda: frame(next(shifts)), 5)
+    changed_calls = (canvas.tk.calls - calls) / 5
+    dispose(canvas)
+    return {
+        'unchanged_seconds': unchanged,
+        'unchanged_tcl_calls': unchanged_calls,
+        'changed_seconds': changed,
+        'changed_tcl_calls': changed_calls,
+    }
+
+
+def bench_pool_decay(root, burst=20000, n_items=100):
+    """Draws one frame of `burst` items, e.g. a zoomed out song, then
+    frames of `n_items` until the pool has shrunk back."""
+    canvas = make_widget(FastCanvas, root)
+
+    def frame(n):
+        canvas.invalidate()
+        for i in range(n):
+            canvas.create_rectangle(i % 800, i % 400, i % 800 + 10, i % 400 + 4, fill='#a8d2d7')
+        canvas.end_frame()
+
+    frame(burst)
+    after_burst = canvas.pool_size
+    frames = 0
+    started = time.perf_counter()
+    while canvas.pool_size > max(n_items, fastcanvas.pool_cap) and frames < 10 * fastcanvas.pool_decay:
+        frame(n_items)
+        frames += 1
+    seconds = (time.perf_counter() - started) / max(frames, 1)
+    stats = canvas.pool_stats()
+    dispose(canvas)
+    return {
+        'items_after_burst': after_burst,
+        'items_after_decay': stats['size'],
+        'frames_to_decay': frames,
+        'frame_seconds': seconds,
+        'evictions': stats['evictions'],
+    }
+
+
+def bench_export(records):
+    store = NoteStore()
+    store.extend_records(records)
+    messages = timed(lambda: notes_to_messages(store))
+    export = timed(lambda: export_to_midi(store, 120, io.BytesIO()))
+    return {'notes_to_messages_seconds': messages, 'export_to_midi_seconds': export}
+
+
+def scheduling_jitter(times, expected):
+    """Lateness of each event compared to its expected time, with the first
+    event as the reference point."""
+    offset = times[0] - expected[0]
+    lateness = [t - offset - e for t, e in zip(times, expected)]
+    return {
+        'mean_jitter_ms': sum(abs(l) for l in lateness) / len(lateness) * 1000,
+        'max_jitter_ms': max(abs(l) for l in lateness) * 1000,
+    }
+
+
+def bench_scheduling(n_notes=100, tempo=1200, tick=0.001):
+    """Plays a short song on a stub synth through the playback engine.
+
+    Meanwhile the main thread sleeps `tick` at a time, the way the Tk
+    thread waits for events, and records how late it wakes up, so an
+    engine holding the GIL shows up too.
+    """
+    song = [Note(notes[i % total_notes], i * 20, i * 20 + 20) for i in range(n_notes)]
+    messages = sorted(notes_to_messages(song), key=lambda m: m[0])
+    expected = [m[0] * 120 / tempo / 1000 for m in messages]
+
+    synth = StubSynth()
+    engine = PlaybackEngine(synth)
+    engine.play(song, tempo)
+    deadline = time.monotonic() + expected[-1] + 5
+    main_thread_delays = []
+    while len(synth.events) < len(messages) and time.monotonic() < deadline:
+        started = time.monotonic()
+        time.sleep(tick)
+        main_thread_delays.append(time.monotonic() - started - tick)
+    engine.close()
+    results = {f'engine_{k}': v for k, v in scheduling_jitter(synth.events, expected).items()}
+    results['main_thread_max_delay_ms'] = max(main_thread_delays, default=0) * 1000
+    return results
+
+
+def run(sizes, display):
+    root = make_root(display)
+    results = {}
+    for n in sizes:
+        print(f'{n} notes...', file=sys.stderr)
+        records = synthetic_records(n)
+        results[f'draw/{n}'] = bench_draw(root, records)
+        # the whole song on screen
+        results[f'draw_zoomed_out/{n}'] = bench_draw(root, records, max(800 / max(r[1] for r in records), piano.min_zoom))
+        results[f'hit_test/{n}'] = bench_hit_test(root, records)
+        results[f'export/{n}'] = bench_export(records)
+    for n in (100, 1000, 10000):
+        results[f'item_reuse/{n}'] = bench_item_reuse(root, n)
+    results['pool_decay'] = bench_pool_decay(root)
+    print('scheduling...', file=sys.stderr)
+    results['scheduling'] = bench_scheduling()
+    return results
+
+
+def compare(results, old_results):
+    """Prints how each timing changed, returning the regressions."""
+    regressions = []
+    for name, metrics in results.items():
+        old_metrics = old_results.get(name, {})
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if not old or not (metric.endswith('seconds') or metric.endswith('_ms')):
+                continue
+            ratio = value / old
+            flag = ''
+            if ratio > 1 + regression_threshold:
+                flag = '  <-- regression'
+                regressions.append(f'{name} {metric}')
+            print(f'{name:24} {metric:36} {old:12.6g} -> {value:12.6g}  x{ratio:.2f}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='note counts to benchmark')
+    parser.add_argument('--display', action='store_true', help='draw on a real Tk window instead of a stand-in')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.display)
+    output = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'display': args.display,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'Wrote {args.output}', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)['results']
+        regressions = compare(results, old_results)
+        if regressions:
+            print(f'{len(regressions)} regressions', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
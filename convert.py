@@ -0,0 +1,152 @@
+"""Converts .notes projects to MIDI and audio files, without a window.
+
+Runs on machines with no display or audio device: nothing here imports
+tkinter, and audio is rendered offline (see render.py). Files are
+converted in parallel, one per worker process.
+
+    python convert.py 'songs/**/*.notes'
+    python convert.py 'songs/*.notes' --to mid wav --tempo 140 --output-dir out
+"""
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from note import export_to_midi, soundfont_path
+from projectfile import NotesFile, is_pickle_file, read_pickle_file
+
+
+formats = ('mid', 'wav')
+
+
+def glob_root(pattern):
+    """Returns the directory a glob pattern starts from, the part of it
+    before the first wildcard."""
+    parts = os.path.normpath(pattern).split(os.sep)[:-1]
+    fixed = []
+    for part in parts:
+        if glob.has_magic(part):
+            break
+        fixed.append(part)
+    return os.sep.join(fixed) or (os.sep if os.path.isabs(pattern) else os.curdir)
+
+
+def expand_inputs(patterns):
+    """Returns the files matching the glob patterns, in order and without
+    duplicates, as (path, directory relative to the pattern's glob root)
+    pairs, and the patterns that matched nothing."""
+    inputs = []
+    seen = set()
+    unmatched = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or ([pattern] if os.path.isfile(pattern) else [])
+        if not matches:
+            unmatched.append(pattern)
+        root = glob_root(pattern)
+        for path in matches:
+            if path not in seen and os.path.isfile(path):
+                seen.add(path)
+                inputs.append((path, os.path.relpath(os.path.dirname(path) or os.curdir, root)))
+    return inputs, unmatched
+
+
+def load_notes(path):
+    if is_pickle_file(path):
+        # files saved by older versions
+        return read_pickle_file(path)
+    with NotesFile(path) as notes_file:
+        return notes_file.to_store()
+
+
+def convert_file(job):
+    """Converts one project to every format asked for. Runs in a worker process.
+
+    Returns (input path, [(output path, seconds), ...], load seconds).
+    """
+    path, to, tempo, directory, soundfont = job
+    started = time.perf_counter()
+    notes = load_notes(path)
+    load_seconds = time.perf_counter() - started
+
+    base = os.path.splitext(os.path.basename(path))[0]
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    outputs = []
+    # the conversions print their own progress, which would interleave
+    # between workers; the results are reported by the parent instead
+    with contextlib.redirect_stdout(io.StringIO()):
+        for extension in to:
+            output = os.path.join(directory, f'{base}.{extension}')
+            started = time.perf_counter()
+            if extension == 'mid':
+                export_to_midi(notes, tempo, output)
+            else:
+                # imported here, since it needs fluidsynth and MIDI doesn't
+                from render import render_to_file
+                # one file per worker already keeps every core busy
+                render_to_file(notes, tempo, output, soundfont, workers=1)
+            outputs.append((output, time.perf_counter() - started))
+    return path, outputs, load_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='.notes files or glob patterns (** matches directories)')
+    parser.add_argument('--to', nargs='+', choices=formats, default=['mid'], help='formats to convert to')
+    parser.add_argument('--tempo', type=int, default=120, help='tempo in bpm')
+    parser.add_argument('--output-dir', help='where to write the files, in the same tree as under each pattern\'s glob root; by default next to each input')
+    parser.add_argument('--soundfont', default=soundfont_path, help='soundfont for rendering audio')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes, by default one per CPU')
+    args = parser.parse_args()
+
+    inputs, unmatched = expand_inputs(args.inputs)
+    for pattern in unmatched:
+        print(f'No files match {pattern}', file=sys.stderr)
+    if not inputs:
+        sys.exit(1)
+
+    soundfont = os.path.abspath(args.soundfont)
+    jobs = []
+    # output path -> the input writing it
+    writers = {}
+    for path, relative in inputs:
+        if args.output_dir is None:
+            directory = os.path.dirname(path)
+        else:
+            # mirrors the tree under the glob root, so that files with the
+            # same name in different directories don't overwrite each other
+            directory = os.path.normpath(os.path.join(args.output_dir, relative))
+        base = os.path.splitext(os.path.basename(path))[0]
+        for extension in args.to:
+            output = os.path.normpath(os.path.join(directory, f'{base}.{extension}'))
+            if output in writers:
+                print(f'{writers[output]} and {path} would both be written to {output}', file=sys.stderr)
+                sys.exit(1)
+            writers[output] = path
+        jobs.append((path, args.to, args.tempo, directory, soundfont))
+    started = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(convert_file, job): job[0] for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                _, outputs, load_seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'[{done}/{len(jobs)}] {path}: failed: {e}', flush=True)
+                continue
+            timings = ', '.join(f'{output} {seconds:.2f} s' for output, seconds in outputs)
+            print(f'[{done}/{len(jobs)}] {path}: loaded {load_seconds:.2f} s, {timings}', flush=True)
+
+    print(f'Converted {len(jobs) - failed} of {len(jobs)} files in {time.perf_counter() - started:.1f} s', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
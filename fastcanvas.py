@@ -2,36 +2,104 @@ import tkinter as tk
 from dataclasses import dataclass
 from typing import Optional
 
+from profiler import profiler
+
+
+# hidden items kept for reuse, per item type. Past this many, the ones
+# unused the longest are deleted
+pool_cap = 1000
+# hidden items unused for this many frames are deleted
+pool_decay = 300
+
+
+def configure_pools(config):
+    """Reads the pool limits from the [Canvas] section of config.ini."""
+    global pool_cap, pool_decay
+    section = config['Canvas'] if config.has_section('Canvas') else {}
+    pool_cap = int(section.get('pool_cap', pool_cap))
+    pool_decay = int(section.get('pool_decay', pool_decay))
+
+
+# Applies a whole frame's worth of item changes in a single call into Tcl:
+# coords/options of reused items, hiding the leftovers, restacking, then
+# deleting the items evicted from the pools.
+APPLY_FRAME_PROC = '''
+proc fastcanvas_apply {w updates hidden order deleted} {
+    foreach {id coords opts} $updates {
+        $w coords $id {*}$coords
+        $w itemconfigure $id -state normal {*}$opts
+    }
+    foreach id $hidden {
+        $w itemconfigure $id -state hidden
+    }
+    foreach id $order {
+        $w raise $id
+    }
+    if {[llength $deleted]} {
+        $w delete {*}$deleted
+    }
+}
+'''
+
 
 @dataclass
 class Rectangle:
     args: tuple
     kwargs: dict
     tk_id: Optional[int] = None
+    # the frame the item was last drawn in
+    last_used: int = 0
 
 @dataclass
 class Line:
     args: tuple
     kwargs: dict
     tk_id: Optional[int] = None
+    last_used: int = 0
 
 @dataclass
 class Text:
     args: tuple
     kwargs: dict
     tk_id: Optional[int] = None
+    last_used: int = 0
 
 
 class FastCanvas(tk.Canvas):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        if profiler.enabled:
+            self.tk = profiler.counting(self.tk)
         self.active_rectangles = []
         self.active_lines = []
         self.active_texts = []
+        # items drawn in the last frame, reversed so they can be popped in order
+        self.previous_rectangles = []
+        self.previous_lines = []
+        self.previous_texts = []
         self.inactive_rectangles = []
         self.inactive_lines = []
         self.inactive_texts = []
 
+        # pending (tk_id, coords, options) triples, flattened
+        self.pending_updates = []
+        # tk ids in the order they were requested this frame
+        self.frame_order = []
+        # tk id -> position in the stacking order, higher is on top
+        self.stack_rank = {}
+        self.next_rank = 0
+        self.flush_scheduled = False
+        self.frame = 0
+        # items reused, items created, and pooled items deleted
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Tcl call count when the current frame started, while profiling
+        self.frame_calls = self.tk.calls if profiler.enabled else None
+
+        if not self.tk.call('info', 'commands', 'fastcanvas_apply'):
+            self.tk.eval(APPLY_FRAME_PROC)
+
     @property
     def n_active_rectangles(self):
         return len(self.active_rectangles)
@@ -44,47 +112,177 @@ class FastCanvas(tk.Canvas):
     def n_active_texts(self):
         return len(self.active_texts)
 
+    @property
+    def pool_size(self):
+        """The number of Tk items the canvas holds on to, drawn or not."""
+        return sum(len(items) for items in (
+            self.active_rectangles, self.previous_rectangles, self.inactive_rectangles,
+            self.active_lines, self.previous_lines, self.inactive_lines,
+            self.active_texts, self.previous_texts, self.inactive_texts,
+        ))
+
+    def pool_stats(self):
+        return {
+            'size': self.pool_size,
+            'hidden': len(self.inactive_rectangles) + len(self.inactive_lines) + len(self.inactive_texts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
     def invalidate(self):
         """Sets all rectangles, lines, and texts to not be active,
         so they can be reused.
         """
-        for rect in self.active_rectangles:
-            self.itemconfigure(rect.tk_id, state=tk.HIDDEN)
-        
-        for line in self.active_lines:
-            self.itemconfigure(line.tk_id, state=tk.HIDDEN)
+        self.begin_frame()
 
-        for text in self.active_texts:
-            self.itemconfigure(text.tk_id, state=tk.HIDDEN)
-        
-        self.inactive_rectangles = self.active_rectangles
+    def begin_frame(self):
+        """Starts a new frame.
+
+        Items from the last frame are handed out again in the order they
+        were created, so an item whose arguments did not change costs
+        nothing. Whatever is not reused is hidden by end_frame.
+        """
+        self.end_frame()
+
+        self.previous_rectangles = self.active_rectangles[::-1]
         self.active_rectangles = []
-        self.inactive_lines = self.active_lines
+        self.previous_lines = self.active_lines[::-1]
         self.active_lines = []
-        self.inactive_texts = self.active_texts
+        self.previous_texts = self.active_texts[::-1]
         self.active_texts = []
+        self.frame_order = []
+        self.frame += 1
+        if profiler.enabled:
+            self.frame_calls = self.tk.calls
+        self.schedule_flush()
+
+    def end_frame(self):
+        """Sends all pending changes of the current frame to Tk in one call."""
+        self.flush_scheduled = False
+
+        hidden = []
+        deleted = []
+        for previous, inactive in (
+            (self.previous_rectangles, self.inactive_rectangles),
+            (self.previous_lines, self.inactive_lines),
+            (self.previous_texts, self.inactive_texts),
+        ):
+            hidden.extend(item.tk_id for item in previous)
+            inactive.extend(previous)
+            previous.clear()
+            deleted.extend(self.evict(inactive))
+
+        order = self.restack_order()
+
+        if self.pending_updates or hidden or order or deleted:
+            self.tk.call('fastcanvas_apply', self._w, tuple(self.pending_updates), tuple(hidden), tuple(order), tuple(deleted))
+            self.pending_updates = []
+
+        if self.frame_calls is not None:
+            name = type(self).__name__
+            profiler.record(f'{name} tcl calls/frame', self.tk.calls - self.frame_calls)
+            profiler.record(f'{name} pool items', self.pool_size)
+            self.frame_calls = None
+
+    def evict(self, inactive):
+        """Takes the items unused for pool_decay frames, and the oldest ones
+        past pool_cap, out of `inactive`, returning their Tk ids.
+
+        Items are reused from the end of the list, so it goes from least
+        to most recently used.
+        """
+        n = max(len(inactive) - pool_cap, 0)
+        oldest = self.frame - pool_decay
+        while n < len(inactive) and inactive[n].last_used <= oldest:
+            n += 1
+        if not n:
+            return []
+        evicted = [item.tk_id for item in inactive[:n]]
+        del inactive[:n]
+        for tk_id in evicted:
+            del self.stack_rank[tk_id]
+        self.evictions += n
+        return evicted
+
+    def restack_order(self):
+        """Returns the items that have to be raised, in order, so that the
+        stacking order matches the order they were requested in this frame.
+        """
+        last = -1
+        for i, tk_id in enumerate(self.frame_order):
+            rank = self.stack_rank[tk_id]
+            if rank < last:
+                break
+            last = rank
+        else:
+            return []
+
+        order = self.frame_order[i:]
+        for tk_id in order:
+            self.stack_rank[tk_id] = self.next_rank
+            self.next_rank += 1
+        return order
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.after_idle(self.end_frame)
+
+    def configure_tag(self, tag, **options):
+        """Changes the options of every item with `tag` in one call, pooled
+        items included.
+
+        The pool's copy of their options is updated too, so the next frame
+        doesn't send the same change item by item. Pooled items only match
+        when `tag` is their only tag.
+        """
+        self.itemconfigure(tag, **options)
+        for items in (
+            self.active_rectangles, self.previous_rectangles, self.inactive_rectangles,
+            self.active_lines, self.previous_lines, self.inactive_lines,
+            self.active_texts, self.previous_texts, self.inactive_texts,
+        ):
+            for item in items:
+                if item.kwargs.get('tags') == tag:
+                    item.kwargs = {**item.kwargs, **options}
+
+    def bbox(self, *args):
+        # make sure reused items are where they were asked to be
+        self.end_frame()
+        return super().bbox(*args)
 
     def create_item(
         self, 
         item, 
         active_list, 
+        previous_list,
         inactive_list, 
         create_func,
         *args, 
         **kwargs
     ):
-        if inactive_list:
+        if previous_list:
+            item = previous_list.pop()
+            if item.args != args or item.kwargs != kwargs:
+                self.pending_updates.extend((item.tk_id, args, self._options(kwargs)))
+            self.hits += 1
+        elif inactive_list:
             item = inactive_list.pop()
-            item.args = args
-            item.kwargs = kwargs
-            self.itemconfigure(item.tk_id, state=tk.NORMAL)
-            super().coords(item.tk_id, *args)
-            super().itemconfig(item.tk_id, **kwargs)
-            self.tag_raise(item.tk_id)  # draw order matters here...
+            self.pending_updates.extend((item.tk_id, args, self._options(kwargs)))
+            self.hits += 1
         else:
             item = item(args, kwargs, create_func(*args, **kwargs))
+            self.stack_rank[item.tk_id] = self.next_rank
+            self.next_rank += 1
+            self.misses += 1
 
+        item.args = args
+        item.kwargs = kwargs
+        item.last_used = self.frame
         active_list.append(item)
+        self.frame_order.append(item.tk_id)
+        self.schedule_flush()
         return item.tk_id
 
     def create_rectangle(self, *args, **kwargs):
@@ -92,18 +290,18 @@ class FastCanvas(tk.Canvas):
         
         If all rectangles are in use, creates a new one.
         """
-        return self.create_item(Rectangle, self.active_rectangles, self.inactive_rectangles, super().create_rectangle, *args, **kwargs)
+        return self.create_item(Rectangle, self.active_rectangles, self.previous_rectangles, self.inactive_rectangles, super().create_rectangle, *args, **kwargs)
 
     def create_line(self, *args, **kwargs):
         """Creates a line. Tries to reuse old lines.
         
         If all lines are in use, creates a new one.
         """
-        return self.create_item(Line, self.active_lines, self.inactive_lines, super().create_line, *args, **kwargs)
+        return self.create_item(Line, self.active_lines, self.previous_lines, self.inactive_lines, super().create_line, *args, **kwargs)
     
     def create_text(self, *args, **kwargs):
         """Creates a text. Tries to reuse old texts.
         
         If all texts are in use, creates a new one.
         """
-        return self.create_item(Text, self.active_texts, self.inactive_texts, super().create_text, *args, **kwargs)
+        return self.create_item(Text, self.active_texts, self.previous_texts, self.inactive_texts, super().create_text, *args, **kwargs)
\ No newline at end of file
@@ -0,0 +1,123 @@
+class Step:
+    """The changes made to a NoteStore by one edit, e.g. a whole drag."""
+    __slots__ = ('added', 'removed', 'changes')
+
+    def __init__(self):
+        # ranges of ids
+        self.added = []
+        self.removed = []
+        # note id -> [state before, state after], see NoteStore.state
+        self.changes = {}
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changes)
+
+    def ids(self):
+        """Returns the ids of all notes the step touches."""
+        ids = set(self.removed)
+        ids.update(self.changes)
+        for added in self.added:
+            ids.update(added)
+        return ids
+
+    def finish(self, store):
+        """Records the final state of changed notes, dropping the ones that
+        ended up where they started."""
+        for note_id, change in list(self.changes.items()):
+            change[1] = store.state(note_id)
+            if change[0] == change[1]:
+                del self.changes[note_id]
+
+    def undo(self, store):
+        for note_id in self.removed:
+            store.revive(note_id)
+        for note_id, (before, _) in self.changes.items():
+            store.restore(note_id, before)
+        for added in self.added:
+            for note_id in added:
+                store.remove(note_id)
+
+    def redo(self, store):
+        for added in self.added:
+            for note_id in added:
+                store.revive(note_id)
+        for note_id, (_, after) in self.changes.items():
+            store.restore(note_id, after)
+        for note_id in self.removed:
+            store.remove(note_id)
+
+
+class History:
+    """Undo and redo for a NoteStore, kept as a log of operations.
+
+    Nothing is ever copied: since note ids are never reused, undoing an add
+    just removes the note again, and undoing a remove brings the note back
+    in its old slot. Each edit costs O(1) time and memory here.
+
+    Operations are grouped into steps. A step starts with the first
+    operation recorded after the previous step ended, and ends with end().
+    """
+
+    def __init__(self, store, limit=1000, on_change=None):
+        self.store = store
+        self.limit = limit
+        # called with the ids of the notes a step touched, whenever one is
+        # ended, undone or redone
+        self.on_change = on_change
+        self.undo_steps = []
+        self.redo_steps = []
+        self.step = None
+
+    def current(self):
+        if self.step is None:
+            self.step = Step()
+        return self.step
+
+    def added(self, ids):
+        """Records that the notes in range `ids` were added."""
+        self.current().added.append(ids)
+
+    def removed(self, note_id):
+        self.current().removed.append(note_id)
+
+    def changing(self, note_id):
+        """Records that a note is about to be changed. Call before changing it."""
+        changes = self.current().changes
+        if note_id not in changes:
+            changes[note_id] = [self.store.state(note_id), None]
+
+    def end(self):
+        """Ends the current step, making it the one undo() reverts next."""
+        step, self.step = self.step, None
+        if step is None:
+            return
+        step.finish(self.store)
+        if step:
+            self.undo_steps.append(step)
+            del self.undo_steps[:-self.limit]
+            self.redo_steps.clear()
+            self.changed(step)
+
+    def changed(self, step):
+        if self.on_change is not None:
+            self.on_change(step.ids())
+
+    def next_undo(self):
+        return self.undo_steps[-1] if self.undo_steps else None
+
+    def next_redo(self):
+        return self.redo_steps[-1] if self.redo_steps else None
+
+    def undo(self):
+        step = self.undo_steps.pop()
+        step.undo(self.store)
+        self.redo_steps.append(step)
+        self.changed(step)
+        return step
+
+    def redo(self):
+        step = self.redo_steps.pop()
+        step.redo(self.store)
+        self.undo_steps.append(step)
+        self.changed(step)
+        return step
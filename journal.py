@@ -0,0 +1,285 @@
+"""Autosave: an append-only journal of edits, compacted into snapshots.
+
+The autosave directory holds generations of files. snapshot-<n>.bin is
+the whole store at the start of generation n, journal-<n>.bin the edits
+made after it. Both are the same stream of records: a note record holds
+the full state of one note by id (ids are never reused, see NoteStore),
+a track record the full state of one track, so replaying is just
+applying every record in order, and a record cut short by a crash is
+simply left out.
+
+Records are packed on the main thread, which only costs as much as the
+edit itself, and written by a background thread that fsyncs at most once
+per `sync_interval`. Snapshots are written from a NoteSnapshot on a
+thread of their own, so saving never waits on the size of the project.
+"""
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from note import NoteStore, Track
+
+
+magic = b'PJN1'
+# kind (b'n' note, b'd' removed note), id, value, start time, end time,
+# velocity, track
+note_format = struct.Struct('<cIBiiBB')
+# b't', track number, channel, program, velocity, name length, then the
+# name in UTF-8
+track_format = struct.Struct('<cBBBBB')
+file_pattern = re.compile(r'(snapshot|journal)-(\d+)\.bin$')
+# notes packed per write while compacting
+chunk_size = 1 << 15
+
+
+def pack_notes(store, ids):
+    pitch, start, end, velocity, track, alive = store.pitch, store.start, store.end, store.velocity, store.track, store.alive
+    return b''.join([
+        note_format.pack(b'n' if alive[i] else b'd', i, pitch[i], start[i], end[i], velocity[i], track[i])
+        for i in ids
+    ])
+
+
+def pack_tracks(tracks):
+    data = bytearray()
+    for number, track in enumerate(tracks):
+        name = track.name.encode('utf-8')[:255]
+        data += track_format.pack(b't', number, track.channel, track.program, track.velocity, len(name))
+        data += name
+    return bytes(data)
+
+
+def replay(store, data):
+    """Applies the records in `data` to `store`, stopping at the first
+    incomplete or unreadable one."""
+    pos = len(magic)
+    end = len(data)
+    while pos < end:
+        kind = data[pos:pos + 1]
+        if kind == b't':
+            if pos + track_format.size > end:
+                return
+            _, number, channel, program, velocity, name_length = track_format.unpack_from(data, pos)
+            pos += track_format.size
+            if pos + name_length > end:
+                return
+            name = bytes(data[pos:pos + name_length]).decode('utf-8', 'replace')
+            pos += name_length
+            while len(store.tracks) <= number:
+                store.tracks.append(Track(f'Track {len(store.tracks) + 1}'))
+            store.tracks[number] = Track(name, channel, program, velocity)
+        elif kind == b'n' or kind == b'd':
+            if pos + note_format.size > end:
+                return
+            _, note_id, value, start_time, end_time, velocity, track = note_format.unpack_from(data, pos)
+            pos += note_format.size
+            # slots skipped over belonged to notes that never got saved
+            while len(store.alive) < note_id:
+                store.remove(store.add(0, 0, 0))
+            if note_id == len(store.alive):
+                store.add(value, start_time, end_time, velocity, track)
+            else:
+                store.restore(note_id, (value, start_time, end_time, velocity, track))
+                store.revive(note_id)
+            if kind == b'd':
+                store.remove(note_id)
+        else:
+            return
+
+
+def generations(directory):
+    """Returns {generation: {'snapshot' or 'journal': path}} of the files in `directory`."""
+    found = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return found
+    for name in names:
+        match = file_pattern.match(name)
+        if match:
+            found.setdefault(int(match[2]), {})[match[1]] = os.path.join(directory, name)
+    return found
+
+
+def fsync_directory(directory):
+    # makes a rename durable, where the OS allows opening directories
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """Saves every change to the notes to `directory` in the background.
+
+    Call compact() with the store to start (and whenever the store is
+    replaced), record_notes() with the ids of the notes an edit touched,
+    and record_tracks() after the tracks change.
+    """
+
+    def __init__(self, directory, sync_interval=1.0, compact_records=100000):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        # compact after this many note records, or right away for an edit
+        # touching more notes than this
+        self.compact_records = compact_records
+        self.records = 0
+        self.commands = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        self.generation = max(generations(directory), default=0)
+        self.thread = threading.Thread(target=self.run, name='autosave', daemon=True)
+        self.thread.start()
+
+    def path(self, kind, generation):
+        return os.path.join(self.directory, f'{kind}-{generation}.bin')
+
+    def recover(self):
+        """Returns the store saved by an earlier session, or None.
+
+        Starts from the newest complete snapshot and replays the journals
+        from its generation on.
+        """
+        found = generations(self.directory)
+        complete = [generation for generation, files in found.items() if 'snapshot' in files]
+        if not complete:
+            return None
+        first = max(complete)
+        store = NoteStore(tracks=[])
+        for generation in sorted(g for g in found if g >= first):
+            for kind in ('snapshot', 'journal'):
+                path = found[generation].get(kind)
+                if path is None or (kind == 'snapshot' and generation != first):
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if data[:len(magic)] == magic:
+                    replay(store, memoryview(data))
+        if not store.tracks:
+            store.tracks.append(Track('Track 1'))
+        return store
+
+    def record_notes(self, store, ids):
+        """Saves the current state of the notes `ids` of `store`."""
+        if len(ids) > self.compact_records:
+            # a snapshot is cheaper for the main thread than packing these
+            self.compact(store)
+            return
+        self.commands.put(('write', pack_notes(store, ids)))
+        self.records += len(ids)
+        if self.records >= self.compact_records:
+            self.compact(store)
+
+    def record_tracks(self, tracks):
+        self.commands.put(('write', pack_tracks(tracks)))
+
+    def compact(self, store):
+        """Starts a new generation from a snapshot of `store`, in O(1) here."""
+        self.records = 0
+        self.commands.put(('compact', store.snapshot()))
+
+    def close(self, discard=False):
+        """Stops saving, after everything recorded so far is on disk. With
+        `discard`, the autosave files are deleted instead."""
+        self.commands.put(('close', discard))
+        self.thread.join()
+
+    def run(self):
+        journal = None
+        unsynced = False
+        last_sync = time.monotonic()
+        compactions = []
+
+        while True:
+            try:
+                if unsynced:
+                    command = self.commands.get(timeout=max(last_sync + self.sync_interval - time.monotonic(), 0))
+                else:
+                    command = self.commands.get()
+            except queue.Empty:
+                command = None
+
+            if command is None:
+                pass
+            elif command[0] == 'write':
+                if journal is None:
+                    journal = self.open_journal()
+                journal.write(command[1])
+                unsynced = True
+            elif command[0] == 'compact':
+                if journal is not None:
+                    journal.close()
+                self.generation += 1
+                journal = self.open_journal()
+                unsynced = True
+                compaction = threading.Thread(target=self.write_snapshot, args=(command[1], self.generation), name='autosave compaction')
+                compaction.start()
+                compactions.append(compaction)
+            elif command[0] == 'close':
+                for compaction in compactions:
+                    compaction.join()
+                if journal is not None:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                    journal.close()
+                if command[1]:
+                    self.delete_older(float('inf'))
+                return
+
+            if unsynced and time.monotonic() - last_sync >= self.sync_interval:
+                journal.flush()
+                os.fsync(journal.fileno())
+                last_sync = time.monotonic()
+                unsynced = False
+            compactions = [compaction for compaction in compactions if compaction.is_alive()]
+
+    def open_journal(self):
+        journal = open(self.path('journal', self.generation), 'ab')
+        if journal.tell() == 0:
+            journal.write(magic)
+        return journal
+
+    def write_snapshot(self, snapshot, generation):
+        store = snapshot.to_store()
+        path = self.path('snapshot', generation)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(magic)
+            f.write(pack_tracks(store.tracks))
+            for first in range(0, len(store.alive), chunk_size):
+                f.write(pack_notes(store, range(first, min(first + chunk_size, len(store.alive)))))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        fsync_directory(self.directory)
+        # the new snapshot covers everything before it
+        self.delete_older(generation)
+
+    def delete_older(self, generation):
+        for older, files in generations(self.directory).items():
+            if older < generation:
+                for path in files.values():
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+
+def journal_from_config(config):
+    """Makes the Journal set up in the [Autosave] section of config.ini, or
+    returns None when autosave is off."""
+    section = config['Autosave'] if config.has_section('Autosave') else {}
+    if section.get('enabled', 'yes').lower() not in ('1', 'yes', 'true', 'on'):
+        return None
+    return Journal(
+        section.get('directory', 'autosave'),
+        sync_interval=float(section.get('sync_interval', 1.0)),
+        compact_records=int(section.get('compact_records', 100000)),
+    )
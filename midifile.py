@@ -0,0 +1,243 @@
+import struct
+
+
+ticks_per_beat = 480
+# flush encoded track data to the destination in pieces this big
+buffer_size = 1 << 16
+
+
+def encode_varlen(value):
+    """Encodes a MIDI variable-length quantity."""
+    out = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+
+def set_tempo_message(tempo):
+    """The set_tempo meta message, `tempo` in microseconds per beat."""
+    return b'\xff\x51\x03' + tempo.to_bytes(3, 'big')
+
+
+def track_name_message(name):
+    data = name.encode('latin-1', 'replace')
+    return b'\xff\x03' + encode_varlen(len(data)) + data
+
+
+def program_change_message(channel, program):
+    return bytes([0xc0 | channel, program])
+
+
+def encode_track(header, events):
+    """Yields the encoded data of one track in pieces.
+
+    `header` is a list of raw messages sent at time 0. `events` yields
+    (tick, status, data1, data2) in time order. Running status is used the
+    same way mido writes it.
+    """
+    data = bytearray()
+    running = None
+    for message in header:
+        data.append(0)
+        data += message
+        running = message[0] if message[0] < 0xf0 else None
+
+    last = 0
+    for tick, status, data1, data2 in events:
+        delta = tick - last
+        last = tick
+        if delta < 0x80:
+            data.append(delta)
+        else:
+            data += encode_varlen(delta)
+        if status != running:
+            data.append(status)
+            running = status
+        data.append(data1)
+        data.append(data2)
+        if len(data) >= buffer_size:
+            yield data
+            data = bytearray()
+
+    # end_of_track
+    data += b'\x00\xff\x2f\x00'
+    yield data
+
+
+def write_midi(destination, tracks):
+    """Writes a type 1 MIDI file to a path or a writable binary stream.
+
+    Each track is a (header, make_events) pair, see encode_track.
+    make_events is called again to get the events when the destination
+    can't seek back to fill in the track length.
+    """
+    if hasattr(destination, 'write'):
+        write_midi_stream(destination, tracks)
+    else:
+        with open(destination, 'wb') as f:
+            write_midi_stream(f, tracks)
+
+
+def write_midi_stream(f, tracks):
+    f.write(b'MThd' + struct.pack('>Lhhh', 6, 1, len(tracks), ticks_per_beat))
+
+    seekable = hasattr(f, 'seekable') and f.seekable()
+    for header, make_events in tracks:
+        if seekable:
+            length_at = f.tell() + 4
+            f.write(b'MTrk\x00\x00\x00\x00')
+            length = 0
+            for piece in encode_track(header, make_events()):
+                f.write(piece)
+                length += len(piece)
+            end = f.tell()
+            f.seek(length_at)
+            f.write(struct.pack('>L', length))
+            f.seek(end)
+        else:
+            length = sum(len(piece) for piece in encode_track(header, make_events()))
+            f.write(b'MTrk' + struct.pack('>L', length))
+            for piece in encode_track(header, make_events()):
+                f.write(piece)
+
+
+class MidiFileError(Exception):
+    pass
+
+
+def read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos
+
+
+def track_notes(data, track_number=0, programs=None, names=None):
+    """Yields (start tick, end tick, value, velocity, channel, track number)
+    for the notes of one track.
+
+    Note offs are matched to note ons per channel and value in a single
+    pass over the raw track data, first in first out. The first program
+    change of each channel is put in the dict `programs` under (track
+    number, channel), and the track name in `names` under the track number.
+    """
+    # channel << 7 | value -> [(start tick, velocity), ...]
+    sounding = {}
+    pos = 0
+    tick = 0
+    running = None
+    end = len(data)
+    while pos < end:
+        delta = data[pos]
+        pos += 1
+        if delta >= 0x80:
+            delta, pos = read_varlen(data, pos - 1)
+        tick += delta
+
+        status = data[pos]
+        if status >= 0x80:
+            pos += 1
+        elif running is None:
+            raise MidiFileError('data byte without a status byte')
+        else:
+            status = running
+
+        if status < 0xa0:
+            # note on or note off
+            running = status
+            value = data[pos]
+            velocity = data[pos + 1]
+            pos += 2
+            key = (status & 0x0f) << 7 | value
+            if status >= 0x90 and velocity:
+                starts = sounding.get(key)
+                if starts is None:
+                    sounding[key] = [(tick, velocity)]
+                else:
+                    starts.append((tick, velocity))
+            else:
+                starts = sounding.get(key)
+                if starts:
+                    start, velocity = starts.pop(0)
+                    yield start, tick, value, velocity, status & 0x0f, track_number
+        elif status < 0xf0:
+            running = status
+            if 0xc0 <= status < 0xd0 and programs is not None:
+                programs.setdefault((track_number, status & 0x0f), data[pos])
+            pos += 1 if 0xc0 <= status < 0xe0 else 2
+        elif status == 0xff:
+            meta_type = data[pos]
+            length, pos = read_varlen(data, pos + 1)
+            if meta_type == 0x03 and names is not None:
+                names.setdefault(track_number, bytes(data[pos:pos + length]).decode('latin-1'))
+            pos += length
+            running = None
+            if meta_type == 0x2f:
+                break
+        elif status == 0xf0 or status == 0xf7:
+            length, pos = read_varlen(data, pos)
+            pos += length
+            running = None
+        else:
+            raise MidiFileError(f'unexpected status byte {status:#x}')
+
+    # notes that never got a note off end with the track
+    for key, starts in sounding.items():
+        for start, velocity in starts:
+            yield start, tick, key & 0x7f, velocity, key >> 7, track_number
+
+
+class MidiFileReader:
+    """Reads the notes out of a MIDI file without decoding it into messages.
+
+    `source` is a path or a readable binary stream.
+    """
+
+    def __init__(self, source):
+        if hasattr(source, 'read'):
+            self.data = memoryview(source.read())
+        else:
+            with open(source, 'rb') as f:
+                self.data = memoryview(f.read())
+
+        if self.data[:4] != b'MThd':
+            raise MidiFileError('not a MIDI file')
+        if len(self.data) < 14:
+            raise MidiFileError('truncated MIDI header')
+        header_length = struct.unpack_from('>L', self.data, 4)[0]
+        self.format, self.n_tracks, self.ticks_per_beat = struct.unpack_from('>hhh', self.data, 8)
+        if self.ticks_per_beat < 0:
+            raise MidiFileError('SMPTE timing is not supported')
+        if self.ticks_per_beat == 0:
+            raise MidiFileError('0 ticks per beat')
+        self.tracks_at = 8 + header_length
+        # filled in while reading notes(), see track_notes
+        self.programs = {}
+        self.track_names = {}
+
+    def tracks(self):
+        """Yields the raw data of each track chunk."""
+        pos = self.tracks_at
+        while pos + 8 <= len(self.data):
+            name = self.data[pos:pos + 4]
+            length = struct.unpack_from('>L', self.data, pos + 4)[0]
+            pos += 8
+            if name == b'MTrk':
+                yield self.data[pos:pos + length]
+            pos += length
+
+    def notes(self):
+        """Yields (start tick, end tick, value, velocity, channel, track number)."""
+        for track_number, data in enumerate(self.tracks()):
+            try:
+                # indexing bytes is quicker than indexing a memoryview
+                yield from track_notes(bytes(data), track_number, self.programs, self.track_names)
+            except IndexError:
+                # a message running past the end of the track
+                raise MidiFileError(f'track {track_number + 1} is truncated') from None
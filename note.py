@@ -1,16 +1,35 @@
-import time
+import copy
+import heapq
+import weakref
+from array import array
+from operator import itemgetter
 from uuid import uuid4
 
-import fluidsynth
-import mido
+from midifile import MidiFileError, MidiFileReader, set_tempo_message, track_name_message, program_change_message, ticks_per_beat, write_midi
 
 
+pitch_classes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
 notes = []
 for octave in range(1, 9):
-    notes += [f'{note}{octave}' for note in ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']]
+    notes += [f'{note}{octave}' for note in pitch_classes]
 
 total_notes = len(notes)
 
+soundfont_path = "synthgms.sf2"
+
+# MIDI ticks (and playback ms at 120 bpm) per pixel of note time
+time_scale = 6
+# a note's track is kept in a byte, see NoteStore
+max_tracks = 256
+
+# Pitch lookup tables, so conversions never have to parse names or search
+# lists. MIDI values use the usual convention of C4 being 60 (A0 is 21,
+# C8 is 108). A note's row is its index in `notes`, from the bottom up.
+midi_note_names = [f'{pitch_classes[value % 12]}{value // 12 - 1}' for value in range(128)]
+midi_note_values = {name: value for value, name in enumerate(midi_note_names)}
+lowest_note_value = midi_note_values[notes[0]]
+
 
 class Note:
     def __init__(self, name, start_time, end_time):
@@ -31,106 +50,495 @@ class Note:
         return note_name_to_value(self.name)
 
 
-def note_name_to_value(note_name):
-    # note: A0 is 21, C8 is 108
-    notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-    note = note_name[:-1]
-    octave = int(note_name[-1])
-    return notes.index(note) + 12 * octave
+class Track:
+    """An instrument: the MIDI channel and program its notes play on, and
+    the velocity new notes get."""
 
+    def __init__(self, name, channel=0, program=0, velocity=90):
+        self.name = name
+        self.channel = channel
+        self.program = program
+        self.velocity = velocity
 
-def note_value_to_name(note_val):
-    notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-    octave = note_val // 12 - 1
-    note = notes[note_val % 12]
-    return note + str(octave)
+    def __repr__(self):
+        return f'Track({self.name!r}, channel={self.channel}, program={self.program})'
 
 
-def notes_to_messages(notes):
-    messages = []
+def free_channel(tracks):
+    """Returns the lowest channel no track uses, leaving out the drum
+    channel, or 0 if all are taken."""
+    used = {track.channel for track in tracks}
+    return next((channel for channel in range(16) if channel != 9 and channel not in used), 0)
 
-    scale = 6
 
-    # Add notes. the "time" in the mido.Message constructor is delta time, 
-    # which is the time between the current message and the next message.
-    for i, note in enumerate(notes):
-        val = note_name_to_value(note.name)
+class NoteView:
+    """A lightweight handle to a note held in a NoteStore.
 
-        # message format: (time, on or off, value, velocity)
-        messages.append((note.start_time*scale, 'note_on', val, 90))
-        messages.append((note.end_time*scale, 'note_off', val, 90))
-    
-    return messages
+    Behaves like a Note (name, start_time, end_time, duration, value), but
+    reads and writes straight through to the store's columns.
+    """
+    __slots__ = ('store', 'id')
 
-def export_to_midi(notes, tempo):
-    # Create a new MIDI file
-    mid = mido.MidiFile()
+    def __init__(self, store, note_id):
+        self.store = store
+        self.id = note_id
 
-    # Add a track to the MIDI file
-    track = mido.MidiTrack()
+    def __repr__(self):
+        return f'Note({self.name}, {self.start_time}, {self.end_time})'
 
-    # get tempo
-    tempo_val = tempo.get()
-    tempo_val = int(tempo_val)
-    tempo_val = 60000000 // tempo_val # convert to microseconds per beat
+    def __eq__(self, other):
+        return isinstance(other, NoteView) and self.store is other.store and self.id == other.id
 
-    # Add the tempo to the track
-    track.append(mido.MetaMessage('set_tempo', tempo=tempo_val))
+    def __hash__(self):
+        return hash(self.id)
 
-    # Add the track to the MIDI file
-    mid.tracks.append(track)
+    @property
+    def name(self):
+        return midi_note_names[self.store.pitch[self.id]]
 
-    messages = notes_to_messages(notes)
+    @name.setter
+    def name(self, name):
+        self.store.touch(self.id)
+        self.store.pitch[self.id] = midi_note_values[name]
 
-    # Sort the messages by time
-    messages.sort(key=lambda m: (m[0]))
+    @property
+    def start_time(self):
+        return self.store.start[self.id]
 
-    # Add the messages to the track
-    for i, message in enumerate(messages):
-        delta = message[0] - messages[i-1][0] if i > 0 else message[0]
-        track.append(mido.Message(message[1], note=message[2], velocity=message[3], time=delta))
+    @start_time.setter
+    def start_time(self, start_time):
+        self.store.touch(self.id)
+        self.store.start[self.id] = start_time
 
-    # Save the MIDI file
-    mid.save('test.mid')
+    @property
+    def end_time(self):
+        return self.store.end[self.id]
 
-    print('Saved MIDI file')
+    @end_time.setter
+    def end_time(self, end_time):
+        self.store.touch(self.id)
+        self.store.end[self.id] = end_time
 
+    @property
+    def velocity(self):
+        return self.store.velocity[self.id]
 
-def open_synth():
-    fs = fluidsynth.Synth(samplerate=44100.0)
-    fs.start()
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
 
-    sfid = fs.sfload("synthgms.sf2")
-    fs.program_select(0, sfid, 0, 0)
+    @property
+    def value(self):
+        return self.store.pitch[self.id]
 
-    return fs
+    @value.setter
+    def value(self, value):
+        self.store.touch(self.id)
+        self.store.pitch[self.id] = value
 
+    @property
+    def row(self):
+        return self.store.pitch[self.id] - lowest_note_value
 
-def convert_to_fluidsynth(notes, tempo, playing, synth=None):
-    messages = notes_to_messages(notes)
+    @property
+    def track(self):
+        return self.store.track[self.id]
+
+
+class NoteStore:
+    """Notes stored column-wise in compact arrays instead of one object each.
+
+    A note's id is its slot in the columns. Ids are handed out in insertion
+    order and are not reused after a note is removed, so iterating over the
+    store goes through the notes in the order they were added, and a
+    removed note can be brought back in its old slot.
+
+    Anything that changes an existing note has to call touch() first, to
+    keep snapshots (see snapshot()) intact.
+
+    Every note belongs to one of `tracks`, by index.
+    """
+
+    def __init__(self, notes=(), tracks=None):
+        self.tracks = tracks if tracks is not None else [Track('Track 1')]
+        self.pitch = array('B')
+        self.start = array('i')
+        self.end = array('i')
+        self.velocity = array('B')
+        self.track = array('B')
+        self.alive = bytearray()
+        self.n_alive = 0
+        self.snapshots = weakref.WeakSet()
+        self.extend(notes)
+
+    def __len__(self):
+        return self.n_alive
+
+    def __getitem__(self, note_id):
+        return NoteView(self, note_id)
+
+    def __iter__(self):
+        for note_id in self.ids():
+            yield NoteView(self, note_id)
+
+    def __contains__(self, note):
+        return isinstance(note, NoteView) and note.store is self and self.alive[note.id]
+
+    def ids(self):
+        return (note_id for note_id, alive in enumerate(self.alive) if alive)
+
+    def records(self, track=None):
+        """Yields (id, value, start_time, end_time, velocity) for every note,
+        or only for the notes of one track."""
+        alive = self.alive
+        if track is None:
+            for record in zip(range(len(alive)), self.pitch, self.start, self.end, self.velocity):
+                if alive[record[0]]:
+                    yield record
+        else:
+            for record, note_track in zip(zip(range(len(alive)), self.pitch, self.start, self.end, self.velocity), self.track):
+                if note_track == track and alive[record[0]]:
+                    yield record
+
+    def ids_by_track(self):
+        """Returns a list of the live note ids of each track, in one pass
+        over the store."""
+        by_track = [[] for _ in self.tracks]
+        n_tracks = len(by_track)
+        track = self.track
+        for note_id in self.ids():
+            note_track = track[note_id]
+            if note_track < n_tracks:
+                by_track[note_track].append(note_id)
+        return by_track
+
+    def add(self, value, start_time, end_time, velocity=90, track=0):
+        note_id = len(self.alive)
+        self.pitch.append(value)
+        self.start.append(start_time)
+        self.end.append(end_time)
+        self.velocity.append(velocity)
+        self.track.append(track)
+        self.alive.append(1)
+        self.n_alive += 1
+        return note_id
+
+    def append(self, note, track=0):
+        """Adds a copy of a Note (or any note-like object) to a track,
+        with the track's velocity, returning its view."""
+        return NoteView(self, self.add(note.value, note.start_time, note.end_time, self.tracks[track].velocity, track))
+
+    def extend(self, notes):
+        """Adds copies of many Notes at once."""
+        notes = list(notes)
+        self.pitch.extend(note_names_to_values([note.name for note in notes]))
+        self.start.extend([note.start_time for note in notes])
+        self.end.extend([note.end_time for note in notes])
+        self.velocity.extend([90] * len(notes))
+        self.track.extend(bytes(len(notes)))
+        self.alive.extend(b'\x01' * len(notes))
+        self.n_alive += len(notes)
+
+    def extend_records(self, records):
+        """Adds notes from (start_time, end_time, value, velocity[, track]) tuples.
+
+        Returns the range of the new ids.
+        """
+        first = len(self.alive)
+        records = list(records)
+        if records:
+            # a pass per column is cheaper than transposing with zip(*records)
+            self.start.extend(map(itemgetter(0), records))
+            self.end.extend(map(itemgetter(1), records))
+            self.pitch.extend(map(itemgetter(2), records))
+            self.velocity.extend(map(itemgetter(3), records))
+            self.track.extend(map(itemgetter(4), records) if len(records[0]) > 4 else bytes(len(records)))
+            self.alive.extend(b'\x01' * len(records))
+            self.n_alive += len(records)
+        return range(first, len(self.alive))
+
+    def remove(self, note_id):
+        if self.alive[note_id]:
+            self.touch(note_id)
+            self.alive[note_id] = 0
+            self.n_alive -= 1
+
+    def revive(self, note_id):
+        """Brings back a removed note, as it was when it was removed."""
+        if not self.alive[note_id]:
+            self.touch(note_id)
+            self.alive[note_id] = 1
+            self.n_alive += 1
+
+    def state(self, note_id):
+        """Returns (value, start_time, end_time, velocity, track) of a note."""
+        return self.pitch[note_id], self.start[note_id], self.end[note_id], self.velocity[note_id], self.track[note_id]
+
+    def restore(self, note_id, state):
+        """Sets a note back to a state returned by state()."""
+        self.touch(note_id)
+        self.pitch[note_id], self.start[note_id], self.end[note_id], self.velocity[note_id], self.track[note_id] = state
+
+    def shift(self, ids, time=0, semitones=0):
+        """Moves the notes `ids` in time and pitch, in one pass over the columns."""
+        self.touch_many(ids)
+        pitch, start, end = self.pitch, self.start, self.end
+        for note_id in ids:
+            start[note_id] += time
+            end[note_id] += time
+            pitch[note_id] += semitones
+
+    def quantize(self, ids, step):
+        """Snaps the start of the notes `ids` to the nearest multiple of
+        `step`, keeping their durations."""
+        self.touch_many(ids)
+        start, end = self.start, self.end
+        for note_id in ids:
+            snapped = (start[note_id] + step // 2) // step * step
+            end[note_id] += snapped - start[note_id]
+            start[note_id] = snapped
+
+    def duplicate(self, ids, time=0):
+        """Adds copies of the notes `ids`, moved by `time`, returning the range of the new ids."""
+        pitch, start, end, velocity, track = self.pitch, self.start, self.end, self.velocity, self.track
+        return self.extend_records([(start[i] + time, end[i] + time, pitch[i], velocity[i], track[i]) for i in ids])
+
+    def touch_many(self, ids):
+        if self.snapshots:
+            for note_id in ids:
+                self.touch(note_id)
+
+    def touch(self, note_id):
+        """Saves a note into the live snapshots before it's changed."""
+        if not self.snapshots:
+            return
+        for snapshot in list(self.snapshots):
+            if note_id < snapshot.length and note_id not in snapshot.saved:
+                snapshot.saved[note_id] = (*self.state(note_id), self.alive[note_id])
+
+    def snapshot(self):
+        """Returns a frozen view of the store as it is now, in O(1)."""
+        snapshot = NoteSnapshot(self)
+        self.snapshots.add(snapshot)
+        return snapshot
+
+
+class NoteSnapshot:
+    """The notes of a NoteStore at one point in time.
+
+    Taking one copies nothing: the store saves the old state of a note
+    into its live snapshots the first time the note changes afterwards, so
+    edits only pay for notes they actually touch. to_store() can be called
+    from any thread while the store keeps being edited.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.length = len(store.alive)
+        self.tracks = [copy.copy(track) for track in store.tracks]
+        # note id -> (value, start_time, end_time, velocity, track, alive) at snapshot time
+        self.saved = {}
+
+    def to_store(self):
+        """Returns a new NoteStore with the notes as they were, keeping their ids."""
+        store = self.store
+        n = self.length
+        frozen = NoteStore(tracks=[copy.copy(track) for track in self.tracks])
+        # the store saves a note before changing it, so any column value
+        # copied here that's already changed has its old value in `saved`
+        frozen.pitch = store.pitch[:n]
+        frozen.start = store.start[:n]
+        frozen.end = store.end[:n]
+        frozen.velocity = store.velocity[:n]
+        frozen.track = store.track[:n]
+        frozen.alive = store.alive[:n]
+        for note_id, (value, start_time, end_time, velocity, track, alive) in dict(self.saved).items():
+            frozen.pitch[note_id] = value
+            frozen.start[note_id] = start_time
+            frozen.end[note_id] = end_time
+            frozen.velocity[note_id] = velocity
+            frozen.track[note_id] = track
+            frozen.alive[note_id] = alive
+        frozen.n_alive = frozen.alive.count(1)
+        return frozen
+
+
+def as_store(notes):
+    """Returns `notes` as a NoteStore, be it one already, a NoteSnapshot
+    or an iterable of Notes."""
+    if isinstance(notes, NoteStore):
+        return notes
+    if isinstance(notes, NoteSnapshot):
+        return notes.to_store()
+    return NoteStore(notes)
 
-    # Sort the messages by time
-    messages.sort(key=lambda m: (m[0]))
 
-    if synth is None:
-        synth = fluidsynth.Synth(samplerate=44100.0)
-        synth.start()
+def note_name_to_value(note_name):
+    # note: A0 is 21, C8 is 108
+    return midi_note_values[note_name]
+
+
+def note_value_to_name(note_val):
+    return midi_note_names[note_val]
+
+
+def note_value_to_row(note_val):
+    return note_val - lowest_note_value
+
+
+def row_y_table(note_height):
+    """Returns the top y pixel of every row, with the highest note at the top."""
+    return [(total_notes - row - 1) * note_height for row in range(total_notes)]
+
+
+def note_names_to_values(names):
+    return array('B', map(midi_note_values.__getitem__, names))
+
+
+def notes_to_messages(notes):
+    messages = []
 
-        sfid = synth.sfload("synthgms.sf2")
-        synth.program_select(0, sfid, 0, 0)
+    scale = time_scale
 
-    playing.set("Playing")
+    notes = as_store(notes)
+    pitch, start, end, velocities = notes.pitch, notes.start, notes.end, notes.velocity
 
-    for i, message in enumerate(messages):
-        if playing.get() == "Playing":
-            delta = message[0] - messages[i-1][0] if i > 0 else message[0]
-            # take into account the tempo
-            delta = delta * 120 / tempo.get()
-            time.sleep(delta / 1000)
-            if message[1] == 'note_on':
-                synth.noteon(0, message[2], message[3])
-            else:
-                synth.noteoff(0, message[2])
+    # Add notes. the "time" in the mido.Message constructor is delta time, 
+    # which is the time between the current message and the next message.
+    for track, ids in zip(notes.tracks, notes.ids_by_track()):
+        channel = track.channel
+        for note_id in ids:
+            val, velocity = pitch[note_id], velocities[note_id]
+            # message format: (time, on or off, value, velocity, channel)
+            messages.append((start[note_id]*scale, 'note_on', val, velocity, channel))
+            messages.append((end[note_id]*scale, 'note_off', val, velocity, channel))
     
-    # print('Finished playing')
-    playing.set("Stopped")
\ No newline at end of file
+    return messages
+
+def sorted_note_events(notes, channel=0, track=None, ids=None):
+    """Yields (tick, status, value, velocity) for every note on and off, in time order.
+
+    Events at the same time come out in the same order as a stable sort of
+    notes_to_messages would give. With `track`, only the notes of that
+    track are included, and with `ids` (live note ids in increasing
+    order, see NoteStore.ids_by_track) only those notes.
+
+    Memory use is still linear in the number of notes: each event is a
+    single integer sort key, kept in an array of 8 bytes per event while
+    the events are taken out. That is a fraction of a list of message
+    tuples, though the sort itself briefly needs the keys as a list.
+    """
+    notes = as_store(notes)
+    if ids is None:
+        ids = [record[0] for record in notes.records(track)]
+
+    # sort key: the tick in the high bits, then 2 * id + 1 for note offs
+    start, end = notes.start, notes.end
+    keys = [(start[note_id] * time_scale) << 32 | note_id << 1 for note_id in ids]
+    keys += [(end[note_id] * time_scale) << 32 | note_id << 1 | 1 for note_id in ids]
+    # one sort of every key is much quicker than merging sorted chunks
+    # of them in Python
+    keys.sort()
+    keys = array('q', keys)
+
+    note_on = 0x90 | channel
+    note_off = 0x80 | channel
+    pitch, velocity = notes.pitch, notes.velocity
+    for key in keys:
+        note_id = (key & 0xffffffff) >> 1
+        yield key >> 32, note_off if key & 1 else note_on, pitch[note_id], velocity[note_id]
+
+
+def merged_note_events(notes):
+    """Yields (tick, status, value, velocity) for the notes of all tracks,
+    on their own channels, in time order.
+
+    Each track's events are sorted on their own and the streams are merged
+    lazily through a heap, so every event costs O(log tracks) to take out.
+    """
+    notes = as_store(notes)
+    streams = [sorted_note_events(notes, track.channel, ids=ids) for track, ids in zip(notes.tracks, notes.ids_by_track())]
+    return heapq.merge(*streams, key=lambda event: event[0])
+
+
+def export_to_midi(notes, tempo, destination='test.mid'):
+    """Writes notes to a MIDI file, at `destination` (a path or a binary stream).
+
+    Each track of the store becomes a track of a type 1 file, encoded
+    straight from the sorted note columns, without building a message
+    object per event.
+    """
+    notes = as_store(notes)
+
+    tempo_val = 60000000 // int(tempo) # convert to microseconds per beat
+
+    tracks = []
+    # split once, rather than scanning the store for each track
+    by_track = notes.ids_by_track()
+    for i, track in enumerate(notes.tracks):
+        header = [set_tempo_message(tempo_val)] if i == 0 else []
+        if len(notes.tracks) > 1:
+            header.append(track_name_message(track.name))
+        if track.program:
+            header.append(program_change_message(track.channel, track.program))
+        tracks.append((header, lambda channel=track.channel, ids=by_track[i]: sorted_note_events(notes, channel, ids=ids)))
+    write_midi(destination, tracks)
+
+    print('Saved MIDI file')
+
+
+def import_from_midi(source, tracks):
+    """Yields the notes of a MIDI file (a path or a binary stream) as
+    (start_time, end_time, value, velocity, track) records, in pixels.
+
+    A Track is appended to the list `tracks` for each channel of each
+    track in the file, and the records refer to those by index.
+    """
+    reader = MidiFileReader(source)
+    # the inverse of the scale used by export_to_midi
+    factor = ticks_per_beat / (reader.ticks_per_beat * time_scale)
+    # (file track, channel) -> index in tracks
+    track_numbers = {}
+    last_channel = last_file_track = track = None
+    for start, end, value, velocity, channel, file_track in reader.notes():
+        # runs of notes usually share a track and channel
+        if channel != last_channel or file_track != last_file_track:
+            last_channel, last_file_track = channel, file_track
+            key = (file_track, channel)
+            track = track_numbers.get(key)
+            if track is None:
+                if len(tracks) == max_tracks:
+                    raise MidiFileError(f'too many tracks and channels, a project can have at most {max_tracks} tracks')
+                track = track_numbers[key] = len(tracks)
+                tracks.append(Track(reader.track_names.get(file_track) or f'Track {len(tracks) + 1}', channel, reader.programs.get(key, 0)))
+        start_time = int(start * factor + 0.5)
+        end_time = int(end * factor + 0.5)
+        yield start_time, end_time if end_time > start_time else start_time + 1, value, velocity, track
+
+
+def open_synth(soundfont=soundfont_path, samplerate=44100, driver=True):
+    """Opens a synth with the soundfont loaded. Without `driver`, it has no
+    audio output of its own and is played by pulling samples from it."""
+    # imported here, since loading fluidsynth is slow and not always needed
+    import fluidsynth
+
+    fs = fluidsynth.Synth(samplerate=float(samplerate))
+    if driver:
+        fs.start()
+
+    sfid = fs.sfload(soundfont)
+    fs.program_select(0, sfid, 0, 0)
+
+    return fs
+
+
+def pcm_bytes(samples):
+    """Returns samples from Synth.get_samples as 16-bit PCM.
+
+    Does what fluidsynth.raw_audio_string does, which calls
+    ndarray.tostring(), gone from NumPy 2.3 on.
+    """
+    # numpy comes with pyFluidSynth, and isn't needed anywhere else
+    import numpy
+
+    return numpy.clip(samples, -32768, 32767).astype(numpy.int16).tobytes()
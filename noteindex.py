@@ -0,0 +1,296 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+
+# rows getting more changes than this in one update() are rebuilt in a
+# single pass instead of changed note by note
+bulk_threshold = 32
+# notes per block of the maximum end kept for overlapping()
+block_size = 64
+inf = float('inf')
+
+
+class PitchIntervals:
+    """Notes on a single pitch, kept sorted by start time.
+
+    For overlapping(), a row also keeps the running maximum of its ends,
+    and splits its notes into blocks of about block_size by start time,
+    with the maximum end of each. Both are kept up to date by add() and
+    remove(), and built again after a rebuild() or once a block has
+    grown to twice its size.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.keys = []
+        # see build_reach()
+        self.reach_stale = True
+        self.running = []
+        self.block_starts = []
+        self.block_ends = []
+        self.block_sizes = []
+        # level -> (starts, ends) of merged spans, see spans()
+        self.span_cache = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, start, end, key):
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.keys.insert(i, key)
+        if not self.reach_stale:
+            running = self.running
+            running.insert(i, max(running[i - 1], end) if i else end)
+            # the running maximum is sorted, so the ones this note raises
+            # are the run after it below its end
+            raised = bisect_left(running, end, i + 1)
+            running[i + 1:raised] = [end] * (raised - i - 1)
+            block = bisect_right(self.block_starts, start) - 1
+            if end > self.block_ends[block]:
+                self.block_ends[block] = end
+            self.block_sizes[block] += 1
+            if self.block_sizes[block] > 2 * block_size:
+                self.reach_stale = True
+        self.span_cache.clear()
+
+    def remove(self, start, key):
+        i = bisect_left(self.starts, start)
+        while i < len(self.starts) and self.starts[i] == start:
+            if self.keys[i] is key or self.keys[i] == key:
+                end = self.ends[i]
+                del self.starts[i]
+                del self.ends[i]
+                del self.keys[i]
+                if not self.reach_stale:
+                    self.unreach(i, start, end)
+                self.span_cache.clear()
+                return True
+            i += 1
+        return False
+
+    def unreach(self, i, start, end):
+        """Takes the note that was at `i` out of the running maximum and
+        its block's maximum end."""
+        running = self.running
+        del running[i]
+        before = running[i - 1] if i else -inf
+        if end > before:
+            # only the notes after it that end by its end, which are all
+            # inside it, can have had their running maximum from it
+            lowered = bisect_right(running, end, i)
+            running[i:lowered] = list(accumulate(self.ends[i:lowered], max, initial=before))[1:]
+
+        block = bisect_right(self.block_starts, start) - 1
+        self.block_sizes[block] -= 1
+        if end >= self.block_ends[block]:
+            first, stop = self.block_range(block)
+            self.block_ends[block] = max(self.ends[first:stop], default=-inf)
+
+    def block_range(self, block, lo=0, hi=None):
+        """Returns the indices of the notes in `block`, within [lo, hi)."""
+        if hi is None:
+            hi = len(self.starts)
+        first = bisect_left(self.starts, self.block_starts[block], lo, hi)
+        if block + 1 == len(self.block_starts):
+            return first, hi
+        return first, bisect_left(self.starts, self.block_starts[block + 1], first, hi)
+
+    def rebuild(self, removed, starts, ends, keys):
+        """Removes the notes with keys in the set `removed` and adds the
+        notes in the lists `starts`, `ends` and `keys`, in one pass over
+        the row."""
+        if removed:
+            kept = [i for i, key in enumerate(self.keys) if key not in removed]
+            starts = [self.starts[i] for i in kept] + starts
+            ends = [self.ends[i] for i in kept] + ends
+            keys = [self.keys[i] for i in kept] + keys
+        else:
+            starts = self.starts + starts
+            ends = self.ends + ends
+            keys = self.keys + keys
+        # sorting indices rather than (start, end, key) tuples keeps a big
+        # batch from making the garbage collector rescan every note; the
+        # sort is stable, so notes already here stay before added ones
+        # starting at the same time
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        self.starts = [starts[i] for i in order]
+        self.ends = [ends[i] for i in order]
+        self.keys = [keys[i] for i in order]
+        self.reach_stale = True
+        self.span_cache.clear()
+
+    def build_reach(self):
+        """Computes the running maximum of the ends and the blocks from scratch.
+
+        A block takes every note starting at the start time of its last
+        one, so blocks split between start times and a note can be found
+        in them by its start alone, however the indices shift. The first
+        block also takes anything added before its first note.
+        """
+        starts, ends = self.starts, self.ends
+        self.running = list(accumulate(ends, max))
+        self.block_starts = [-inf]
+        self.block_ends = []
+        self.block_sizes = []
+        first = 0
+        while first < len(starts):
+            stop = bisect_right(starts, starts[min(first + block_size, len(starts)) - 1], first)
+            if first:
+                self.block_starts.append(starts[first])
+            self.block_ends.append(max(ends[first:stop]))
+            self.block_sizes.append(stop - first)
+            first = stop
+        if not self.block_ends:
+            self.block_ends.append(-inf)
+            self.block_sizes.append(0)
+        self.reach_stale = False
+
+    def overlapping(self, x0, x1):
+        """Yields the indices of notes with start < x1 and end > x0."""
+        if self.reach_stale:
+            self.build_reach()
+        # every note before lo ends by x0
+        lo = bisect_right(self.running, x0)
+        hi = bisect_left(self.starts, x1)
+        starts, ends = self.starts, self.ends
+        i = lo
+        while i < hi:
+            block = bisect_right(self.block_starts, starts[i]) - 1
+            _, stop = self.block_range(block, i, hi)
+            # a long note only keeps its own block from being skipped
+            if self.block_ends[block] > x0:
+                for j in range(i, stop):
+                    if ends[j] > x0:
+                        yield j
+            i = stop
+
+    def spans(self, level):
+        """Returns the notes merged into non-overlapping spans, as sorted
+        (starts, ends) lists.
+
+        Notes less than 2**level apart are merged, so that a zoomed out
+        view draws one item where it couldn't show the gap anyway. The
+        result is cached per level until the notes change.
+        """
+        cached = self.span_cache.get(level)
+        if cached is not None:
+            return cached
+
+        gap = 1 << level
+        starts = []
+        ends = []
+        for start, end in zip(self.starts, self.ends):
+            if ends and start <= ends[-1] + gap:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.span_cache[level] = (starts, ends)
+        return starts, ends
+
+    def spans_overlapping(self, x0, x1, level):
+        """Yields (start, end) of the merged spans overlapping [x0, x1)."""
+        starts, ends = self.spans(level)
+        # spans don't overlap, so the ends are sorted too
+        lo = bisect_right(ends, x0)
+        hi = bisect_left(starts, x1)
+        for i in range(lo, hi):
+            yield starts[i], ends[i]
+
+
+class NoteIndex:
+    """Spatial index over notes, with one sorted interval list per pitch.
+
+    Notes are identified by an opaque key. Hit tests and viewport queries
+    only look at the notes that can possibly overlap the query range,
+    instead of scanning every note.
+    """
+
+    def __init__(self, n_pitches):
+        self.pitches = [PitchIntervals() for _ in range(n_pitches)]
+        # bumped on every change, so views can tell when to redraw
+        self.version = 0
+
+    def __len__(self):
+        return sum(len(p) for p in self.pitches)
+
+    def clear(self):
+        for p in self.pitches:
+            p.__init__()
+        self.version += 1
+
+    def add(self, row, start, end, key):
+        self.pitches[row].add(start, end, key)
+        self.version += 1
+
+    def remove(self, row, start, key):
+        self.version += 1
+        return self.pitches[row].remove(start, key)
+
+    def update(self, removed=(), added=()):
+        """Removes the (row, start, key) notes in `removed` and adds the
+        (row, start, end, key) notes in `added`, as one batch."""
+        removed_by_row = [[] for _ in self.pitches]
+        for row, start, key in removed:
+            removed_by_row[row].append((start, key))
+        # the added notes are split by row into columns
+        starts_by_row = [[] for _ in self.pitches]
+        ends_by_row = [[] for _ in self.pitches]
+        keys_by_row = [[] for _ in self.pitches]
+        for row, start, end, key in added:
+            starts_by_row[row].append(start)
+            ends_by_row[row].append(end)
+            keys_by_row[row].append(key)
+
+        for p, row_removed, starts, ends, keys in zip(self.pitches, removed_by_row, starts_by_row, ends_by_row, keys_by_row):
+            if not row_removed and not keys:
+                continue
+            if len(row_removed) + len(keys) > bulk_threshold:
+                p.rebuild({key for _, key in row_removed}, starts, ends, keys)
+            else:
+                for start, key in row_removed:
+                    p.remove(start, key)
+                for start, end, key in zip(starts, ends, keys):
+                    p.add(start, end, key)
+        self.version += 1
+
+    def length(self):
+        """Returns the end time of the last note."""
+        return max((p.spans(0)[1][-1] for p in self.pitches if p.keys), default=0)
+
+    def at(self, row, x):
+        """Returns the key of the first note on `row` covering `x`, or None."""
+        if not 0 <= row < len(self.pitches):
+            return None
+        p = self.pitches[row]
+        for i in p.overlapping(x, x + 1):
+            if p.starts[i] <= x:
+                return p.keys[i]
+        return None
+
+    def overlapping(self, x0, x1, rows=None):
+        """Yields (row, start, end, key) for notes overlapping [x0, x1)."""
+        if rows is None:
+            rows = range(len(self.pitches))
+        for row in rows:
+            p = self.pitches[row]
+            if not p.keys:
+                continue
+            for i in p.overlapping(x0, x1):
+                yield row, p.starts[i], p.ends[i], p.keys[i]
+
+    def spans(self, x0, x1, level, rows=None):
+        """Yields (row, start, end) for merged spans overlapping [x0, x1),
+        see PitchIntervals.spans."""
+        if rows is None:
+            rows = range(len(self.pitches))
+        for row in rows:
+            p = self.pitches[row]
+            if not p.keys:
+                continue
+            for start, end in p.spans_overlapping(x0, x1, level):
+                yield row, start, end
\ No newline at end of file
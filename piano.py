@@ -1,18 +1,56 @@
+import time
+launch_time = time.perf_counter()
+
 import configparser
+import math
 import os
-import pickle
 import random
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-import time
-import threading
 
-from note import Note, notes, total_notes, export_to_midi, convert_to_fluidsynth, open_synth
-from fastcanvas import FastCanvas
+from note import Note, NoteStore, Track, free_channel, notes, total_notes, lowest_note_value, max_tracks, time_scale, row_y_table, note_value_to_row, export_to_midi, import_from_midi
+from fastcanvas import FastCanvas, configure_pools
+from noteindex import NoteIndex
+from history import History
+from journal import journal_from_config
+from playback import engine_from_config
+from profiler import profiler
+from midifile import MidiFileError
+from projectfile import NotesFile, NotesFileError, write_notes_file, is_pickle_file, read_pickle_file, convert_pickle_file
 
 note_width = 40
 note_height = 20
 grid_spacing = 20
+# vertical grid lines are spaced further apart when zoomed out, to keep
+# them at least this many pixels apart
+min_grid_gap = 8
+# top y pixel of each row
+row_y = row_y_table(note_height)
+# zoom is in screen pixels per time pixel
+min_zoom = 1 / 1024
+max_zoom = 4
+zoom_step = 1.25
+# notes only get a name label from this zoom on
+label_zoom = 1
+# below this zoom, notes are drawn as merged spans per pitch instead
+lod_zoom = 0.5
+# notes closer than this many screen pixels merge into one span
+lod_gap = 4
+overview_height = 48
+# the overview redraws its notes at most this often, in seconds
+overview_refresh = 0.25
+
+
+def row_at(y):
+    """Returns the row under canvas y position `y`."""
+    return total_notes - int(y // note_height) - 1
+
+
+def lod_level(zoom, gap=1):
+    """Returns the span level (see NoteIndex.spans) that merges notes less
+    than `gap` screen pixels apart at `zoom`."""
+    return max(0, math.ceil(math.log2(gap / zoom)))
 
 
 class ColorScheme:
@@ -28,60 +66,174 @@ class ColorScheme:
         self.grid_lines_horiz = '#' + config_section['grid_lines_horiz']
         self.grid_lines_horiz_octave = '#' + config_section['grid_lines_horiz_octave']
         self.note = '#' + config_section['note']
+        # themes from before selection had a colour of its own
+        self.note_selected = '#' + config_section.get('note_selected', config_section['note'])
+
+
+# semantic tag -> (item option, ColorScheme attribute) of the canvas items
+# a color scheme applies to, so a theme change is one call per tag
+theme_tags = {
+    'black_keys': ('fill', 'black_keys'),
+    'white_keys': ('fill', 'white_keys'),
+    'c_keys': ('fill', 'c_keys'),
+    'grid_bg_black': ('fill', 'grid_bg_black'),
+    'grid_bg_white': ('fill', 'grid_bg_white'),
+    'grid_lines_vert': ('fill', 'grid_lines_vert'),
+    'grid_lines_vert_4': ('fill', 'grid_lines_vert_4'),
+    'grid_lines_vert_16': ('fill', 'grid_lines_vert_16'),
+    'grid_lines_horiz': ('fill', 'grid_lines_horiz'),
+    'grid_lines_horiz_octave': ('fill', 'grid_lines_horiz_octave'),
+    'note': ('fill', 'note'),
+    'note_selected': ('outline', 'note_selected'),
+    'playhead': ('fill', 'note_selected'),
+    'band': ('outline', 'note_selected'),
+    'view': ('outline', 'note'),
+}
+# section name -> parsed ColorScheme
+color_schemes = {}
+
+
+def color_scheme(name):
+    scheme = color_schemes.get(name)
+    if scheme is None:
+        scheme = color_schemes[name] = ColorScheme(config[name])
+    return scheme
+
+
+def scheme_names():
+    return [section for section in config.sections() if section.startswith('colors.')]
+
+
+def recolor(canvas):
+    """Applies the current color scheme to the items on `canvas`."""
+    for tag, (option, attribute) in theme_tags.items():
+        canvas.configure_tag(tag, **{option: getattr(cs, attribute)})
 
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 scheme = config['Main']['color_scheme']
-cs = ColorScheme(config[scheme])
+cs = color_scheme(scheme)
+profiler.configure(config)
+configure_pools(config)
+# the note canvas redraws at most this many times per second
+redraw_rate = config['Main'].getfloat('redraw_rate', 60)
 
 
 class MenuControls(tk.Frame):
-    def __init__(self, parent, synth):
+    def __init__(self, parent):
         super().__init__(parent)
         self.parent = parent
-        self.synth = synth
+        # opens the synth in the background, see PlaybackEngine
+        self.engine = engine_from_config(config)
         self.create_widgets()
+        self.poll_playback()
 
     def create_widgets(self):
         self.midi_export_btn = ttk.Button(self, text='Export as MIDI', command=self.export_as_midi)
         self.midi_export_btn.grid(row=0, column=0)
 
+        self.midi_import_btn = ttk.Button(self, text='Import MIDI', command=self.import_midi)
+        self.midi_import_btn.grid(row=0, column=1)
+
         self.reset_btn = ttk.Button(self, text='Reset', command=self.reset)
-        self.reset_btn.grid(row=0, column=1)
+        self.reset_btn.grid(row=0, column=2)
 
         self.export_btn = ttk.Button(self, text='Export', command=self.export_notes)
-        self.export_btn.grid(row=0, column=2)
+        self.export_btn.grid(row=0, column=3)
 
         self.import_btn = ttk.Button(self, text='Import', command=self.import_notes)
-        self.import_btn.grid(row=0, column=3)
+        self.import_btn.grid(row=0, column=4)
 
         self.tempo_label = ttk.Label(self, text='Tempo')
-        self.tempo_label.grid(row=0, column=4)
+        self.tempo_label.grid(row=0, column=5)
 
         self.tempo_var = tk.IntVar()
         self.tempo_var.set(120)
+        self.tempo_var.trace_add('write', self.tempo_changed)
         self.tempo = ttk.Spinbox(self, from_=1, to=300, textvariable=self.tempo_var)
-        self.tempo.grid(row=0, column=5)
+        self.tempo.grid(row=0, column=6)
 
         self.playing = tk.StringVar()
         self.playing.set("Stopped")
 
         self.play_btn = ttk.Button(self, text='Play', command=self.play)
-        self.play_btn.grid(row=0, column=6)
+        self.play_btn.grid(row=0, column=7)
 
         self.stop_btn = ttk.Button(self, text='Stop', command=self.stop)
-        self.stop_btn.grid(row=0, column=7)
+        self.stop_btn.grid(row=0, column=8)
 
         self.playing_text = tk.Label(self, textvariable=self.playing)
-        self.playing_text.grid(row=0, column=8)
+        self.playing_text.grid(row=0, column=9)
+
+        # scroll along with the playhead
+        self.follow_var = tk.BooleanVar(value=True)
+        self.follow = ttk.Checkbutton(self, text='Follow', variable=self.follow_var)
+        self.follow.grid(row=1, column=7)
+
+        self.track_label = ttk.Label(self, text='Track')
+        self.track_label.grid(row=1, column=0)
+
+        self.track_select = ttk.Combobox(self, state='readonly')
+        self.track_select.grid(row=1, column=1, columnspan=2)
+        self.track_select.bind('<<ComboboxSelected>>', self.track_selected)
+
+        self.scheme_label = ttk.Label(self, text='Colors')
+        self.scheme_label.grid(row=1, column=8)
+
+        self.scheme_select = ttk.Combobox(self, state='readonly', values=[name.removeprefix('colors.') for name in scheme_names()])
+        self.scheme_select.set(scheme.removeprefix('colors.'))
+        self.scheme_select.grid(row=1, column=9)
+        self.scheme_select.bind('<<ComboboxSelected>>', lambda e: self.parent.set_color_scheme('colors.' + self.scheme_select.get()))
+
+        self.add_track_btn = ttk.Button(self, text='Add track', command=self.add_track)
+        self.add_track_btn.grid(row=1, column=3)
+
+        self.program_label = ttk.Label(self, text='Program')
+        self.program_label.grid(row=1, column=5)
+
+        self.program_var = tk.IntVar()
+        self.program = ttk.Spinbox(self, from_=0, to=127, textvariable=self.program_var)
+        self.program.grid(row=1, column=6)
+        self.program_var.trace_add('write', self.program_changed)
+
+        self.update_tracks()
 
     def export_as_midi(self):
-        export_to_midi(self.parent.note_entry.notes, self.tempo_var)
+        extension = ".mid"
+        filename = filedialog.asksaveasfilename(initialdir = os.getcwd(), title = "Select file", filetypes = (("MIDI files", "*.mid"), ("All files", "*.*")))
+        if filename:
+            if not filename.endswith(extension):
+                filename += extension
+            self.in_background(export_to_midi, self.parent.note_entry.notes.snapshot(), self.get_tempo(), filename)
+        else:
+            messagebox.showerror("Error", "No file selected")
+
+    def import_midi(self):
+        filename = filedialog.askopenfilename(initialdir = os.getcwd(), title = "Select file", filetypes = (("MIDI files", "*.mid *.midi"), ("All files", "*.*")))
+        if filename:
+            note_entry = self.parent.note_entry
+            # the file's tracks are added after the existing ones
+            tracks = list(note_entry.notes.tracks)
+            try:
+                records = list(import_from_midi(filename, tracks))
+            except (MidiFileError, OSError) as e:
+                messagebox.showerror("Error", f"Couldn't read MIDI file: {e}")
+                return
+
+            # the roll can only show C1 to B8
+            in_range = [r for r in records if 0 <= note_value_to_row(r[2]) < total_notes]
+            note_entry.notes.tracks[:] = tracks
+            note_entry.add_records(in_range)
+            self.update_tracks()
+            if len(in_range) < len(records):
+                messagebox.showinfo("Import MIDI", f"Skipped {len(records) - len(in_range)} notes outside of the piano roll's range")
+        else:
+            messagebox.showerror("Error", "No file selected")
 
     def reset(self):
-        self.parent.note_entry.notes = []
-        self.parent.note_entry.draw()
+        self.parent.note_entry.set_notes([])
+        self.update_tracks()
 
     def export_notes(self):
         extension = ".notes"
@@ -89,44 +241,107 @@ class MenuControls(tk.Frame):
         if filename:
             if not filename.endswith(extension):
                 filename += extension
-            with open(filename, 'wb') as f:
-                pickle.dump(self.parent.note_entry.notes, f)
+            self.in_background(write_notes_file, filename, self.parent.note_entry.notes.snapshot())
         else:
             messagebox.showerror("Error", "No file selected")
 
     def import_notes(self):
         filename = filedialog.askopenfilename(initialdir = os.getcwd(), title = "Select file", filetypes = (("note files", "*.notes"), ("All files", "*.*")))
         if filename:
-            with open(filename, 'rb') as f:
-                self.parent.note_entry.notes = pickle.load(f)
-            self.parent.note_entry.draw()
+            if is_pickle_file(filename):
+                # files saved by older versions
+                try:
+                    if messagebox.askyesno("Old file format", "This file uses the old .notes format. Convert it to the new format?"):
+                        store = convert_pickle_file(filename)
+                    else:
+                        store = read_pickle_file(filename)
+                except (NotesFileError, OSError) as e:
+                    messagebox.showerror("Error", str(e))
+                    return
+                self.parent.note_entry.set_notes(store)
+                self.update_tracks()
+                return
+
+            try:
+                notes_file = NotesFile(filename)
+            except NotesFileError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            self.parent.note_entry.load_notes_file(notes_file)
+            self.update_tracks()
         else:
             messagebox.showerror("Error", "No file selected")
 
+    def update_tracks(self):
+        """Brings the track controls and the synth's programs in line with
+        the tracks of the notes."""
+        note_entry = self.parent.note_entry
+        tracks = note_entry.notes.tracks
+        self.track_select['values'] = [track.name for track in tracks]
+        self.track_select.current(note_entry.current_track)
+        self.program_var.set(tracks[note_entry.current_track].program)
+        self.engine.set_programs(tracks)
+        note_entry.journal_tracks()
+
+    def track_selected(self, event):
+        self.parent.note_entry.current_track = self.track_select.current()
+        self.update_tracks()
+
+    def add_track(self):
+        note_entry = self.parent.note_entry
+        tracks = note_entry.notes.tracks
+        if len(tracks) == max_tracks:
+            messagebox.showinfo("Add track", f"A project can have at most {max_tracks} tracks")
+            return
+        tracks.append(Track(f'Track {len(tracks) + 1}', free_channel(tracks)))
+        note_entry.current_track = len(tracks) - 1
+        self.update_tracks()
+
+    def program_changed(self, *args):
+        try:
+            program = min(max(self.program_var.get(), 0), 127)
+        except tk.TclError:
+            # the spinbox is empty or being edited
+            return
+        note_entry = self.parent.note_entry
+        track = note_entry.notes.tracks[note_entry.current_track]
+        if track.program != program:
+            track.program = program
+            self.engine.set_programs([track])
+            note_entry.journal_tracks()
+
+    def in_background(self, func, *args):
+        """Runs func on its own thread, so exporting a large project doesn't
+        freeze the window. Give it a snapshot of the notes, not the store."""
+        threading.Thread(target=func, args=args, name=func.__name__).start()
+
+    def get_tempo(self):
+        try:
+            return max(self.tempo_var.get(), 1)
+        except tk.TclError:
+            # the spinbox is empty or being edited
+            return 120
+
+    def tempo_changed(self, *args):
+        self.engine.set_tempo(self.get_tempo())
+
+    def poll_playback(self):
+        # the engine runs on its own thread, so its state is copied over here
+        if self.playing.get() != self.engine.state:
+            self.playing.set(self.engine.state)
+            if self.engine.state == 'Playing':
+                self.parent.note_entry.start_playhead(self.engine)
+        self.after(50, self.poll_playback)
+
     def play(self):
-        # run in a separate thread so the GUI doesn't freeze
-        t = threading.Thread(
-            target=convert_to_fluidsynth,
-            args=(self.parent.note_entry.notes, self.tempo_var, self.playing, self.synth),
-        )
-        t.start()
+        self.engine.play(self.parent.note_entry.notes.snapshot(), self.get_tempo())
 
     def play_single_note(self, note):
-        # run in a separate thread so the GUI doesn't freeze
-        # create new note with the start time as 0
-        new_note = Note(
-            name=note.name,
-            start_time=0,
-            end_time=note.duration,
-        )
-        t = threading.Thread(
-            target=convert_to_fluidsynth,
-            args=([new_note], self.tempo_var, self.playing, self.synth),
-        )
-        t.start()
+        track = self.parent.note_entry.notes.tracks[note.track]
+        self.engine.preview(note.value, note.duration, self.get_tempo(), track.channel)
 
     def stop(self):
-        self.playing.set("Stopped")
+        self.engine.stop()
 
 
 def pick_dumb_word():
@@ -152,6 +367,32 @@ class MainApp(tk.Tk):
         super().__init__()
         self.title(f'{pick_dumb_word()} piano thing')
         self.create_widgets()
+        self.start_autosave()
+        self.protocol('WM_DELETE_WINDOW', self.close)
+        self.after_idle(self.report_startup)
+
+    def start_autosave(self):
+        """Saves the notes in the background from now on, first offering to
+        restore the session left behind by a crash, see Journal."""
+        self.journal = journal_from_config(config)
+        if self.journal is None:
+            return
+        self.note_entry.journal = self.journal
+        store = self.journal.recover()
+        if store is not None and len(store) and messagebox.askyesno("Restore session", f"The last session didn't close properly. Restore its {len(store)} notes?"):
+            self.note_entry.set_notes(store)
+            self.menu_controls.update_tracks()
+        else:
+            self.journal.compact(self.note_entry.notes)
+
+    def close(self):
+        # a clean exit leaves nothing to restore
+        if self.journal is not None:
+            self.journal.close(discard=True)
+        self.destroy()
+
+    def report_startup(self):
+        print(f'Window ready in {(time.perf_counter() - launch_time) * 1000:.0f} ms')
 
     def canvas_yviews(self, *args, **kwargs):
         self.piano_roll.yview(*args, **kwargs)
@@ -163,14 +404,12 @@ class MainApp(tk.Tk):
         self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
 
-        self.synth = open_synth()
-
         self.piano_roll = PianoRoll(self.frame, mainapp=self)
         self.piano_roll.grid(row=0, column=0, sticky='nsew')
         self.frame.grid_rowconfigure(0, weight=1)
         self.piano_roll.update()
 
-        self.note_entry = NoteEntry(self.frame, mainapp=self, synth=self.synth)
+        self.note_entry = NoteEntry(self.frame, mainapp=self)
         self.note_entry.grid(row=0, column=1, sticky='nsew')
         self.frame.grid_rowconfigure(0, weight=1)
         self.frame.grid_columnconfigure(1, weight=1)
@@ -187,6 +426,16 @@ class MainApp(tk.Tk):
         self.horizontal_scrollbar.grid(row=1, column=0, columnspan=2, sticky='ew')
         self.horizontal_scrollbar.set(0.25, 0.75)
 
+        self.overview = Overview(self.frame, note_entry=self.note_entry)
+        self.overview.grid(row=2, column=1, sticky='ew')
+
+        self.bind('<Control-equal>', lambda e: self.note_entry.set_zoom(self.note_entry.zoom * zoom_step))
+        self.bind('<Control-minus>', lambda e: self.note_entry.set_zoom(self.note_entry.zoom / zoom_step))
+        self.bind('<Control-0>', lambda e: self.note_entry.set_zoom(1))
+        # undo and redo are bound on the note canvas, so they don't fire
+        # while typing in the toolbar; it has the focus until clicked away
+        self.note_entry.focus_set()
+
         pr_bb = self.piano_roll.bbox('all')
         pr_width = pr_bb[2] - (pr_bb[0] if pr_bb[0] >= 0 else 0)
         pr_height = pr_bb[3] - (pr_bb[1] if pr_bb[1] >= 0 else 0) - 1
@@ -199,9 +448,23 @@ class MainApp(tk.Tk):
         self.note_entry.configure(yscrollcommand=self.vertical_scrollbar.set)
         self.note_entry.configure(scrollregion=(0, 0, ne_width, ne_height))
 
-        self.menu_controls = MenuControls(self, synth=self.synth)
+        self.menu_controls = MenuControls(self)
         self.menu_controls.grid(row=1, column=0)
 
+        profiler.start(self.note_entry)
+
+    def set_color_scheme(self, name):
+        """Switches to another color scheme while running.
+
+        Items are recolored in place through their semantic tags (see
+        theme_tags), nothing is redrawn.
+        """
+        global cs
+        cs = color_scheme(name)
+        for canvas in (self.piano_roll, self.note_entry, self.overview):
+            recolor(canvas)
+        self.overview.configure(background=cs.grid_bg_black)
+
     def scroll_canvases(self, event):
         self.piano_roll.yview_scroll(int(-1*(event.delta/120)), "units")
         self.note_entry.yview_scroll(int(-1*(event.delta/120)), "units")
@@ -214,12 +477,13 @@ class MainApp(tk.Tk):
             if args[2] == 'pages':
                 direction *= 4
 
-            self.note_entry.x_offset += 20 * direction
+            # 20 screen pixels, whatever the zoom
+            self.note_entry.x_offset += round(20 * direction / self.note_entry.zoom) or direction
 
         if self.note_entry.x_offset < 0:
             self.note_entry.x_offset = 0
 
-        self.note_entry.draw()
+        self.note_entry.request_redraw()
 
 
 class PianoRoll(FastCanvas):
@@ -233,104 +497,629 @@ class PianoRoll(FastCanvas):
         for i, note in enumerate(notes[::-1]):
             x = 0
             y = i * note_height
-            fill = cs.black_keys if note[1] == '#' else cs.white_keys if note[0] != 'C' else cs.c_keys
-            self.create_rectangle(x, y, x+note_width, y+note_height+1, fill=fill)
+            tag = 'black_keys' if note[1] == '#' else 'white_keys' if note[0] != 'C' else 'c_keys'
+            self.create_rectangle(x, y, x+note_width, y+note_height+1, fill=getattr(cs, tag), tags=tag)
             # if note is C, draw the note name
             if note[:-1] == 'C':
-                self.create_text(x+note_width - 4, y+note_height/2, text=note, anchor='e')
+                self.create_text(x+note_width - 4, y+note_height/2, text=note, anchor='e', tags='key_label')
 
 
 class NoteEntry(FastCanvas):
-    def __init__(self, parent, mainapp, synth=None, **kwargs):
+    def __init__(self, parent, mainapp, **kwargs):
         self.width = 800
         self.height = 400
         self.x_offset = 0
+        self.zoom = 1
         self.new_note_width = 40
         self.resize_gap = 8
-        self.synth = synth
-        self.notes = []
+        self.notes = NoteStore()
+        self.index = NoteIndex(total_notes)
+        # saves edits in the background, when autosave is on
+        self.journal = None
+        self.history = History(self.notes, on_change=self.journal_notes)
+        # new notes go to this track
+        self.current_track = 0
+        self.grid_key = None
+        self.grid_phase = 0
+        # note id -> [rectangle id, text id, placed coords, placed name, drawn as selected]
+        self.note_items = {}
+        # ids of the selected notes, which may include removed ones
+        self.selection = set()
+        self.active_note = None
+        # (x0, y0, x1, y1) in time pixels and canvas y while dragging out a
+        # selection, and the rectangle showing it
+        self.band = None
+        self.band_item = None
+        # the engine being followed, the line showing its position, and
+        # the time pixel and window x the line was put at
+        self.playhead_engine = None
+        self.playhead_item = None
+        self.playhead_time = None
+        self.playhead_x = None
+        self.drawn_x_offset = 0
+        self.drawn_zoom = 1
+        # (NotesFile, chunk iterator) while a file is being loaded
+        self.loading = None
+        # set when the canvas needs a full draw at the next frame
+        self.dirty = False
+        # after id of the next frame, if one is scheduled
+        self.frame_pending = None
+        self.last_frame = 0.0
+        # (handler, event) of motion events waiting for the next frame
+        self.pending_motions = []
         super().__init__(parent, width=self.width, height=self.height, borderwidth=0, highlightthickness=0, **kwargs)
         self.parent = parent
         self.mainapp = mainapp
 
         self.bind('<Button-1>', self.left_click_handler)
-        self.bind('<B1-Motion>', self.left_click_drag_handler)
+        self.bind('<Shift-Button-1>', self.band_start)
+        self.bind('<B1-Motion>', lambda e: self.queue_motion(self.band_drag if self.band else self.left_click_drag_handler, e))
+        self.bind('<ButtonRelease-1>', lambda e: self.band_end() if self.band else self.end_edit())
         self.bind('<Button-3>', self.right_click_handler)
-        self.bind('<B3-Motion>', self.right_click_drag_handler)
-        self.bind('<Motion>', lambda e: self.check_hover(e.x, e.y))
+        self.bind('<B3-Motion>', lambda e: self.queue_motion(self.right_click_drag_handler, e, merge=False))
+        self.bind('<ButtonRelease-3>', lambda e: self.end_edit())
+        self.bind('<Motion>', lambda e: self.queue_motion(self.hover_handler, e))
         self.bind('<Configure>', self.resize_canvas)
+        self.bind('<Control-MouseWheel>', lambda e: self.set_zoom(self.zoom * zoom_step ** (e.delta / 120), e.x))
+
+        # selection keys, only while the canvas has the focus (see the click handlers)
+        self.bind('<Up>', lambda e: self.transpose_selection(1))
+        self.bind('<Down>', lambda e: self.transpose_selection(-1))
+        self.bind('<Shift-Up>', lambda e: self.transpose_selection(12))
+        self.bind('<Shift-Down>', lambda e: self.transpose_selection(-12))
+        self.bind('<Left>', lambda e: self.shift_selection(-grid_spacing))
+        self.bind('<Right>', lambda e: self.shift_selection(grid_spacing))
+        self.bind('<q>', lambda e: self.quantize_selection())
+        self.bind('<Control-d>', lambda e: self.duplicate_selection())
+        self.bind('<Delete>', lambda e: self.delete_selection())
+        self.bind('<BackSpace>', lambda e: self.delete_selection())
+        self.bind('<Control-a>', lambda e: self.select_all())
+        self.bind('<Control-z>', lambda e: self.undo())
+        self.bind('<Control-y>', lambda e: self.redo())
+        self.bind('<Control-Z>', lambda e: self.redo())
+        self.bind('<Escape>', lambda e: self.clear_selection())
+
+    @property
+    def visible_time(self):
+        """The width of the canvas in time pixels."""
+        return self.width / self.zoom
+
+    def world_x(self, x):
+        """Converts a window x position to time pixels."""
+        return (x + self.canvasx(0)) / self.zoom + self.x_offset
+
+    def set_zoom(self, zoom, anchor_x=0):
+        """Zooms horizontally, keeping the time under window x `anchor_x` in place."""
+        zoom = min(max(zoom, min_zoom), max_zoom)
+        anchor = self.world_x(anchor_x)
+        self.zoom = zoom
+        self.x_offset = max(0, round(anchor - (anchor_x + self.canvasx(0)) / zoom))
+        self.request_redraw()
+
+    def request_redraw(self):
+        """Marks the canvas as needing a draw at the next frame."""
+        self.dirty = True
+        self.schedule_frame()
+
+    def queue_motion(self, handler, event, merge=True):
+        """Defers a motion event to the next frame.
+
+        With `merge`, a run of events for the same handler collapses into
+        the latest one, since only the final position matters for moving
+        or hovering. Erasing keeps every event so no note is skipped.
+        """
+        if profiler.enabled:
+            # input latency counts from here, see Profiler.input_handler
+            event.queued_at = time.perf_counter()
+        if merge and self.pending_motions and self.pending_motions[-1][0] == handler:
+            if profiler.enabled:
+                # from the first of the merged events, the one waited on longest
+                event.queued_at = getattr(self.pending_motions[-1][1], 'queued_at', event.queued_at)
+            self.pending_motions[-1] = (handler, event)
+        else:
+            self.pending_motions.append((handler, event))
+        self.schedule_frame()
+
+    def schedule_frame(self):
+        if self.frame_pending is not None:
+            return
+        delay = self.last_frame + 1 / redraw_rate - time.perf_counter()
+        if delay > 0:
+            self.frame_pending = self.after(int(delay * 1000) + 1, self.run_frame)
+        else:
+            self.frame_pending = self.after_idle(self.run_frame)
+
+    def run_frame(self):
+        self.frame_pending = None
+        self.last_frame = time.perf_counter()
+        self.flush_motions()
+        if self.dirty:
+            self.dirty = False
+            self.draw()
+
+    def flush_motions(self):
+        """Handles the motion events waiting for the next frame right away."""
+        motions, self.pending_motions = self.pending_motions, []
+        for handler, event in motions:
+            handler(event)
 
+    @profiler.timed('NoteEntry.draw')
     def draw(self):
         self.invalidate()
 
         self.width = self.winfo_width()
+        self.draw_grid()
 
-        for i, note in enumerate(notes[::-1]):
-            x = 0
-            y = i * note_height
-            fill = cs.grid_bg_black if note[1] == '#' else cs.grid_bg_white
-            self.create_rectangle(0, y, self.width, y+note_height, fill=fill, width=0)
-
-        # Draw the grid, horizontal lines first, then vertical
-        for y in range(0, total_notes+1):
-            y = y * note_height
-            self.create_line(0, y, self.width, y, fill=cs.grid_lines_horiz_octave if y % (note_height * 12) == 0 else cs.grid_lines_horiz)
-
-        for x in range(0, self.width, grid_spacing):
-            adjusted_x = x + self.x_offset
-            fill = cs.grid_lines_vert_16 if adjusted_x % 64 == 0 else cs.grid_lines_vert_4 if adjusted_x % 16 == 0 else cs.grid_lines_vert
-            self.create_line(x, 0, x, total_notes * note_height, fill=fill)
-
-        # Draw the notes
-        for note in self.notes:
-            # handle notes that are partially on the screen
-            if note.start_time < self.x_offset and note.end_time > self.x_offset:
-                # draw what we can
-                partial_width = note.end_time - self.x_offset
-                note_x = 0
-                note_y = total_notes * note_height - (notes.index(note.name) + 1) * note_height
-                self.create_rectangle(note_x, note_y, partial_width, note_y+note_height, fill=cs.note, width=1)
-
-                # add note text
-                self.create_text(note_x + 6, note_y+note_height/2, text=note.name, anchor='w')
-
-            elif note.start_time >= self.x_offset and note.start_time < self.x_offset + self.width:
-                note_x = note.start_time - self.x_offset
-                note_y = total_notes * note_height - (notes.index(note.name) + 1) * note_height
-                self.create_rectangle(note_x, note_y, note_x+note.duration, note_y+note_height, fill=cs.note, width=1)
-
-                # add note text
-                self.create_text(note_x + 6, note_y+note_height/2, text=note.name, anchor='w')
+        if self.zoom != self.drawn_zoom:
+            # every note item is in the wrong place now
+            self.delete('notes')
+            self.note_items = {}
+            self.drawn_zoom = self.zoom
+            self.drawn_x_offset = self.x_offset
+
+        if self.zoom < lod_zoom:
+            self.draw_spans()
+        else:
+            self.draw_notes()
+
+        # pooled items are restacked when the frame is sent to Tk, so it
+        # has to be sent before raising anything above them
+        self.end_frame()
+        if self.playhead_time is not None:
+            # keep it on top of the notes, and in place after a scroll or zoom
+            self.tag_raise(self.playhead_item)
+            self.place_playhead()
+        if self.band is not None:
+            self.tag_raise(self.band_item)
+
+    def draw_grid(self):
+        """Draws the background and grid lines as a separate, persistent layer.
+
+        The layer is only rebuilt when the width or zoom changes, a new
+        color scheme recolors it through its tags. Scrolling shifts the
+        vertical lines with a single move, since their pattern repeats
+        every `period` time pixels.
+        """
+        step = grid_spacing
+        while step * self.zoom < min_grid_gap:
+            step *= 2
+        period = math.lcm(step, 64)
+
+        key = (self.width, self.zoom)
+        if key != self.grid_key:
+            self.delete('grid')
+            self.grid_key = key
+            self.grid_phase = 0
+
+            for i, note in enumerate(notes[::-1]):
+                y = i * note_height
+                tag = 'grid_bg_black' if note[1] == '#' else 'grid_bg_white'
+                tk.Canvas.create_rectangle(self, 0, y, self.width, y+note_height, fill=getattr(cs, tag), width=0, tags=('grid', tag))
+
+            # Draw the grid, horizontal lines first, then vertical
+            for y in range(0, total_notes+1):
+                y = y * note_height
+                tag = 'grid_lines_horiz_octave' if y % (note_height * 12) == 0 else 'grid_lines_horiz'
+                tk.Canvas.create_line(self, 0, y, self.width, y, fill=getattr(cs, tag), tags=('grid', tag))
+
+            # one extra period so the lines still cover the width once shifted
+            for x in range(0, int(self.visible_time) + period, step):
+                tag = 'grid_lines_vert_16' if x % 64 == 0 else 'grid_lines_vert_4' if x % 16 == 0 else 'grid_lines_vert'
+                tk.Canvas.create_line(self, x * self.zoom, 0, x * self.zoom, total_notes * note_height, fill=getattr(cs, tag), tags=('grid', 'grid_vert', tag))
+
+            self.tag_lower('grid')
+
+        phase = (self.x_offset % period) * self.zoom
+        if phase != self.grid_phase:
+            self.move('grid_vert', self.grid_phase - phase, 0)
+            self.grid_phase = phase
+
+    def draw_notes(self):
+        """Brings the note items in line with the notes in the viewport.
+
+        Note items are kept between draws: scrolling moves all of them with
+        one call, and only notes entering or leaving the viewport (or
+        clipped at its left edge) cause further canvas calls.
+        """
+        dx = self.drawn_x_offset - self.x_offset
+        if dx:
+            self.move('notes', dx * self.zoom, 0)
+            self.drawn_x_offset = self.x_offset
+
+        visible = set()
+        for row, start_time, end_time, note_id in self.index.overlapping(self.x_offset, self.x_offset + self.visible_time):
+            visible.add(note_id)
+            self.place_note(note_id, row, start_time, end_time)
+
+        for note_id in [note_id for note_id in self.note_items if note_id not in visible]:
+            self.delete_note_items(note_id)
+
+    def draw_spans(self):
+        """Draws the notes zoomed out: per pitch, notes that would be too
+        close together to tell apart are merged into a single unlabeled
+        span. The spans come from the index, cached per zoom level, and
+        their number is bounded by the width of the canvas, not by the
+        number of notes.
+        """
+        for note_id in list(self.note_items):
+            self.delete_note_items(note_id)
+
+        x0 = self.x_offset
+        for row, start_time, end_time in self.index.spans(x0, x0 + self.visible_time, lod_level(self.zoom, lod_gap)):
+            y = row_y[row]
+            left = max(start_time - x0, 0) * self.zoom
+            right = max((end_time - x0) * self.zoom, left + 1)
+            self.create_rectangle(left, y, right, y+note_height, fill=cs.note, width=0, tags='note')
+
+    def place_note(self, note_id, row, start_time, end_time):
+        """Creates or moves the canvas items of a single note.
+
+        Items are placed relative to drawn_x_offset, where the other note
+        items are, since a scroll waiting for the next draw moves them all.
+        """
+        name = notes[row]
+        note_y = row_y[row]
+        # handle notes that are partially on the screen
+        left = max(start_time, self.x_offset)
+        note_x = (left - self.drawn_x_offset) * self.zoom
+        note_end = (end_time - self.drawn_x_offset) * self.zoom
+        placed = (left, note_y, end_time)
+
+        selected = note_id in self.selection
+
+        items = self.note_items.get(note_id)
+        if items is None:
+            if selected:
+                rect = tk.Canvas.create_rectangle(self, note_x, note_y, note_end, note_y+note_height, fill=cs.note, outline=cs.note_selected, width=2, tags=('notes', 'note', 'note_selected'))
+            else:
+                rect = tk.Canvas.create_rectangle(self, note_x, note_y, note_end, note_y+note_height, fill=cs.note, width=1, tags=('notes', 'note'))
+            text = None
+            if self.zoom >= label_zoom:
+                text = tk.Canvas.create_text(self, note_x + 6, note_y+note_height/2, text=name, anchor='w', tags=('notes', 'note_label'))
+            self.note_items[note_id] = [rect, text, placed, name, selected]
+            return
+
+        rect, text, old_placed, old_name, old_selected = items
+        if placed != old_placed:
+            self.coords(rect, note_x, note_y, note_end, note_y+note_height)
+            if text is not None:
+                self.coords(text, note_x + 6, note_y+note_height/2)
+            items[2] = placed
+        if name != old_name:
+            if text is not None:
+                self.itemconfigure(text, text=name)
+            items[3] = name
+        if selected != old_selected:
+            if selected:
+                self.itemconfigure(rect, outline=cs.note_selected, width=2, tags=('notes', 'note', 'note_selected'))
+            else:
+                self.itemconfigure(rect, outline='black', width=1, tags=('notes', 'note'))
+            items[4] = selected
+
+    def update_note(self, note):
+        """Redraws a single note after it was added, moved or resized."""
+        if self.zoom < lod_zoom:
+            self.request_redraw()
+        elif note.end_time > self.x_offset and note.start_time < self.x_offset + self.visible_time:
+            self.place_note(note.id, note.row, note.start_time, note.end_time)
+        elif note.id in self.note_items:
+            self.delete_note_items(note.id)
+
+    def delete_note_items(self, note_id):
+        rect, text = self.note_items.pop(note_id)[:2]
+        if text is None:
+            self.delete(rect)
+        else:
+            self.delete(rect, text)
+
+    def set_notes(self, new_notes):
+        if self.loading is not None:
+            self.loading[0].close()
+            self.loading = None
+
+        self.notes = new_notes if isinstance(new_notes, NoteStore) else NoteStore(new_notes)
+        self.history = History(self.notes, on_change=self.journal_notes)
+        self.current_track = 0
+        self.selection = set()
+        self.active_note = None
+        self.rebuild_index()
+        if self.journal is not None:
+            self.journal.compact(self.notes)
+
+    def journal_notes(self, ids):
+        if self.journal is not None:
+            self.journal.record_notes(self.notes, ids)
+
+    def journal_tracks(self):
+        if self.journal is not None:
+            self.journal.record_tracks(self.notes.tracks)
+
+    def rebuild_index(self):
+        self.index.clear()
+        for note_id, value, start_time, end_time, _ in self.notes.records():
+            self.index.add(note_value_to_row(value), start_time, end_time, note_id)
+        self.delete('notes')
+        self.note_items = {}
+        self.request_redraw()
+
+    def load_notes_file(self, notes_file):
+        """Loads a NotesFile a chunk at a time from the event loop.
+
+        The records are sorted by start time, so the notes at the start of
+        the song (where the view is) show up after the first chunk, and the
+        window stays responsive while the rest loads.
+        """
+        self.set_notes(NoteStore(tracks=notes_file.tracks()))
+        self.loading = (notes_file, notes_file.chunks())
+        self.load_next_chunk()
+
+    def load_next_chunk(self):
+        if self.loading is None:
+            return
+
+        notes_file, chunks = self.loading
+        chunk = next(chunks, None)
+        if chunk is None:
+            notes_file.close()
+            self.loading = None
+            # the chunks aren't journaled one by one, they're all in this
+            if self.journal is not None:
+                self.journal.compact(self.notes)
+            return
+
+        # only redraw if the chunk reaches into the viewport
+        self.add_records(chunk, redraw=chunk[0][0] < self.x_offset + self.visible_time, undoable=False)
+        self.after(1, self.load_next_chunk)
+
+    def add_records(self, records, redraw=True, undoable=True):
+        """Adds many notes at once from (start_time, end_time, value, velocity, ...) records.
+
+        With `undoable`, they're added as a single undo step.
+        """
+        notes = self.notes
+        ids = notes.extend_records(records)
+        # straight from the new ends of the columns, without a tuple per record
+        first = ids.start
+        rows = [value - lowest_note_value for value in notes.pitch[first:]]
+        self.index.update(added=zip(rows, notes.start[first:], notes.end[first:], ids))
+        if undoable:
+            self.history.end()
+            self.history.added(ids)
+            self.history.end()
+        if redraw:
+            self.request_redraw()
+
+    def index_note(self, note):
+        self.index.add(note.row, note.start_time, note.end_time, note.id)
+
+    def unindex_note(self, note):
+        self.index.remove(note.row, note.start_time, note.id)
 
     def add_note(self, note):
-        self.notes.append(note)
-        self.draw()
+        """Adds a copy of `note` to the store, returning the stored note."""
+        note = self.notes.append(note, self.current_track)
+        self.history.added(range(note.id, note.id + 1))
+        self.index_note(note)
+        self.update_note(note)
+        return note
 
     def remove_note(self, note):
-        self.notes.remove(note)
-        self.draw()
+        self.unindex_note(note)
+        self.history.removed(note.id)
+        self.notes.remove(note.id)
+        if note.id in self.note_items:
+            self.delete_note_items(note.id)
+        elif self.zoom < lod_zoom:
+            self.request_redraw()
+
+    def end_edit(self):
+        """Ends the undo step of the edit in progress."""
+        self.flush_motions()
+        self.history.end()
+
+    def drop_active_note(self):
+        """Ends the edit in progress and stops a drag from going on with
+        its note, which the caller is about to undo or remove."""
+        self.end_edit()
+        self.active_note = None
+
+    def undo(self):
+        self.drop_active_note()
+        step = self.history.next_undo()
+        if step is not None:
+            self.apply_step(step, self.history.undo)
+
+    def redo(self):
+        self.drop_active_note()
+        step = self.history.next_redo()
+        if step is not None:
+            self.apply_step(step, self.history.redo)
+
+    def apply_step(self, step, apply):
+        """Undoes or redoes `step` with `apply`, keeping the index in line
+        with the notes it touches."""
+        ids = step.ids()
+        removed = self.index_entries(ids)
+        apply()
+        self.index.update(removed, self.index_entries(ids, ends=True))
+        self.request_redraw()
+
+    def index_entries(self, ids, ends=False):
+        """Returns the (row, start_time, key) index entries of the alive
+        notes among `ids`, or with `ends` (row, start_time, end_time, key)."""
+        notes = self.notes
+        pitch, start, end, alive = notes.pitch, notes.start, notes.end, notes.alive
+        if ends:
+            return [(note_value_to_row(pitch[i]), start[i], end[i], i) for i in ids if alive[i]]
+        return [(note_value_to_row(pitch[i]), start[i], i) for i in ids if alive[i]]
+
+    def selected_ids(self):
+        alive = self.notes.alive
+        return [note_id for note_id in self.selection if alive[note_id]]
+
+    def select(self, ids):
+        self.selection = set(ids)
+        self.request_redraw()
+
+    def select_all(self):
+        self.select(record[0] for record in self.notes.records())
+
+    def clear_selection(self):
+        if self.selection:
+            self.select(())
+
+    def edit_notes(self, ids, edit):
+        """Applies `edit`, a batched change to the notes `ids` (see
+        NoteStore.shift), as one undo step, updating the index in one go
+        and redrawing once."""
+        self.end_edit()
+        removed = self.index_entries(ids)
+        for note_id in ids:
+            self.history.changing(note_id)
+        edit(ids)
+        self.index.update(removed, self.index_entries(ids, ends=True))
+        self.history.end()
+        self.request_redraw()
+
+    def transpose_selection(self, semitones):
+        ids = self.selected_ids()
+        if not ids:
+            return
+        # keep every note on the roll
+        rows = [note_value_to_row(self.notes.pitch[note_id]) for note_id in ids]
+        semitones = min(max(semitones, -min(rows)), total_notes - 1 - max(rows))
+        if semitones:
+            self.edit_notes(ids, lambda ids: self.notes.shift(ids, semitones=semitones))
+
+    def shift_selection(self, time):
+        ids = self.selected_ids()
+        if not ids:
+            return
+        time = max(time, -min(self.notes.start[note_id] for note_id in ids))
+        if time:
+            self.edit_notes(ids, lambda ids: self.notes.shift(ids, time=time))
+
+    def quantize_selection(self):
+        ids = self.selected_ids()
+        if ids:
+            self.edit_notes(ids, lambda ids: self.notes.quantize(ids, grid_spacing))
+
+    def duplicate_selection(self):
+        """Copies the selected notes to just after the selection, and selects the copies."""
+        ids = self.selected_ids()
+        if not ids:
+            return
+        self.end_edit()
+        start, end = self.notes.start, self.notes.end
+        span = max(end[note_id] for note_id in ids) - min(start[note_id] for note_id in ids)
+        # whole grid steps, so the copies stay on the grid
+        copies = self.notes.duplicate(ids, -(-span // grid_spacing) * grid_spacing)
+        self.index.update(added=self.index_entries(copies, ends=True))
+        self.history.added(copies)
+        self.history.end()
+        self.select(copies)
+
+    def delete_selection(self):
+        ids = self.selected_ids()
+        if not ids:
+            return
+        self.drop_active_note()
+        self.index.update(removed=self.index_entries(ids))
+        for note_id in ids:
+            self.history.removed(note_id)
+            self.notes.remove(note_id)
+        self.history.end()
+        self.select(())
+
+    def start_playhead(self, engine):
+        """Shows where `engine` is in the song until it stops playing."""
+        self.playhead_engine = engine
+        if self.playhead_item is None:
+            # drawn straight onto the canvas, not through the FastCanvas pool
+            self.playhead_item = tk.Canvas.create_line(self, 0, 0, 0, 0, fill=cs.note_selected, width=2, tags='playhead')
+        if self.playhead_time is None:
+            self.playhead_time = 0
+            self.tick_playhead()
+
+    def tick_playhead(self):
+        """Moves the playhead to the engine's position, once a frame.
+
+        Only the line itself moves, so a tick costs the same whatever the
+        number of notes. The view only scrolls (a page at a time) once the
+        playhead leaves it.
+        """
+        engine = self.playhead_engine
+        if engine.state != 'Playing':
+            self.playhead_time = None
+            self.playhead_x = None
+            self.coords(self.playhead_item, 0, 0, 0, 0)
+            return
+
+        self.playhead_time = engine.position() / time_scale
+        if self.mainapp.menu_controls.follow_var.get() and not self.x_offset <= self.playhead_time < self.x_offset + self.visible_time:
+            self.x_offset = int(self.playhead_time)
+            self.request_redraw()
+        self.place_playhead()
+        self.after(int(1000 / redraw_rate), self.tick_playhead)
+
+    def place_playhead(self):
+        x = round((self.playhead_time - self.x_offset) * self.zoom)
+        if x != self.playhead_x:
+            self.coords(self.playhead_item, x, 0, x, total_notes * note_height)
+            self.playhead_x = x
+
+    def band_start(self, event):
+        """Starts dragging out a selection rectangle."""
+        self.focus_set()
+        self.end_edit()
+        self.active_note = None
+        x, y = self.world_x(event.x), event.y + self.canvasy(0)
+        self.band = (x, y, x, y)
+        if self.band_item is None:
+            # drawn straight onto the canvas, not through the FastCanvas pool
+            self.band_item = tk.Canvas.create_rectangle(self, 0, 0, 0, 0, outline=cs.note_selected, dash=(4, 2), tags='band')
+        self.place_band()
+
+    def band_drag(self, event):
+        x0, y0, _, _ = self.band
+        self.band = (x0, y0, self.world_x(event.x), event.y + self.canvasy(0))
+        self.place_band()
+
+    def place_band(self):
+        x0, y0, x1, y1 = self.band
+        self.coords(self.band_item, (x0 - self.x_offset) * self.zoom, y0, (x1 - self.x_offset) * self.zoom, y1)
+        self.tag_raise(self.band_item)
+
+    def band_end(self):
+        """Selects the notes touching the selection rectangle."""
+        self.flush_motions()
+        x0, y0, x1, y1 = self.band
+        self.band = None
+        self.coords(self.band_item, 0, 0, 0, 0)
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((max(y0, 0), min(y1, total_notes * note_height - 1)))
+        rows = range(row_at(y1), row_at(y0) + 1)
+        self.select(note_id for _, _, _, note_id in self.index.overlapping(x0, x1, rows=rows))
+
+    def note_at(self, x, y):
+        """Returns the note under canvas position (x, y), or None."""
+        note_id = self.index.at(row_at(y), x)
+        if note_id is None:
+            return None
+        return self.notes[note_id]
 
     def is_inside_note(self, x, y):
         note_x = int((x // grid_spacing) * grid_spacing)
-        note_y = int((y // grid_spacing) * grid_spacing)
-
-        for note in self.notes:
-            inside_note = (
-                note_x >= note.start_time
-                and note_x < note.end_time
-                and note_y >= total_notes * note_height - (notes.index(note.name) + 1) * note_height
-                and note_y <= total_notes * note_height - (notes.index(note.name) + 1) * note_height
-            )
-            if inside_note:
-                if note.end_time - x < self.resize_gap:
-                    return note, 'resize'
-                else:
-                    return note, 'move'
-        else:
+        note = self.note_at(note_x, y)
+
+        if note is None:
             return (False, False)
+        if note.end_time - x < self.resize_gap / self.zoom:
+            return note, 'resize'
+        return note, 'move'
 
     def check_hover(self, x, y):
-        x, y = x + self.canvasx(0) + self.x_offset, y + self.canvasy(0)
+        x, y = self.world_x(x), y + self.canvasy(0)
 
         note, action = self.is_inside_note(x, y)
 
@@ -348,24 +1137,31 @@ class NoteEntry(FastCanvas):
             ne_width = bb[2] - (bb[0] if bb[0] >= 0 else 0)
             ne_height = bb[3] - (bb[1] if bb[1] >= 0 else 0) - 1
             self.config(scrollregion=(0, 0, ne_width, ne_height))
-            self.update()
-            self.draw()
+            self.request_redraw()
+
+    @staticmethod
+    def hover_handler(event):
+        event.widget.check_hover(event.x, event.y)
 
     @staticmethod
+    @profiler.input_handler('left click')
     def left_click_handler(event):
         canvas = event.widget
+        # drags still waiting for a frame belong to the previous press
+        canvas.flush_motions()
+        canvas.focus_set()
+        canvas.clear_selection()
 
         orig_x, orig_y = event.x, event.y
-        x, y = event.x + canvas.canvasx(0) + canvas.x_offset, event.y + canvas.canvasy(0)
+        x, y = canvas.world_x(event.x), event.y + canvas.canvasy(0)
         grid_x = int((x // grid_spacing) * grid_spacing)
         grid_y = int((y // grid_spacing) * grid_spacing)
 
         note, canvas.action = canvas.is_inside_note(x, y)
 
         if not note:
-            note_name = notes[total_notes - grid_y // note_height - 1]
-            note = Note(note_name, grid_x, grid_x+canvas.new_note_width)
-            canvas.add_note(note)
+            note_name = notes[row_at(grid_y)]
+            note = canvas.add_note(Note(note_name, grid_x, grid_x+canvas.new_note_width))
             canvas.active_note = note
             canvas.action = 'move'
             canvas.active_note_offset = grid_x - note.start_time
@@ -380,9 +1176,10 @@ class NoteEntry(FastCanvas):
         canvas.last_played_note = canvas.active_note.name
 
     @staticmethod
+    @profiler.input_handler('left drag')
     def left_click_drag_handler(event):
         canvas = event.widget
-        x, y = event.x + canvas.canvasx(0) + canvas.x_offset, event.y + canvas.canvasy(0)
+        x, y = canvas.world_x(event.x), event.y + canvas.canvasy(0)
 
         # prevent dragging above the top note (out of the window) going out of bounds later
         if y < 0:
@@ -394,41 +1191,47 @@ class NoteEntry(FastCanvas):
         grid_x = int((x // grid_spacing) * grid_spacing)
         grid_y = int((y // grid_spacing) * grid_spacing)
 
-        if canvas.active_note:
+        # the note may have been removed under the drag, e.g. by an erase
+        if canvas.active_note and canvas.active_note in canvas.notes:
+            # don't jump back by 1 size just after resizing
+            if canvas.action == 'resize' and x < canvas.active_note.end_time and x + canvas.resize_gap / canvas.zoom > canvas.active_note.end_time:
+                return
+
+            canvas.history.changing(canvas.active_note.id)
+            canvas.unindex_note(canvas.active_note)
             if canvas.action == 'move':
                 duration = canvas.active_note.duration
                 canvas.active_note.start_time = grid_x - canvas.active_note_offset
                 if canvas.active_note.start_time < 0:
                     canvas.active_note.start_time = 0
                 canvas.active_note.end_time = canvas.active_note.start_time + duration
-                canvas.active_note.name = notes[total_notes - grid_y // note_height - 1]
+                canvas.active_note.name = notes[row_at(grid_y)]
                 if canvas.active_note.name != canvas.last_played_note:
                     canvas.mainapp.menu_controls.play_single_note(canvas.active_note)
                     canvas.last_played_note = canvas.active_note.name
             elif canvas.action == 'resize':
-                # don't jump back by 1 size just after resizing
-                if x < canvas.active_note.end_time and x + canvas.resize_gap > canvas.active_note.end_time:
-                    return
-
                 canvas.active_note.end_time = grid_x
                 if canvas.active_note.duration <= 0:
                     canvas.active_note.end_time = canvas.active_note.start_time + 20
                 canvas.new_note_width = canvas.active_note.duration
-            canvas.draw()
+            canvas.index_note(canvas.active_note)
+            canvas.update_note(canvas.active_note)
 
     @staticmethod
+    @profiler.input_handler('right click')
     def right_click_handler(event):
         canvas = event.widget
-        x, y = int(event.x + canvas.canvasx(0) + canvas.x_offset), int(event.y + canvas.canvasy(0))
-        for note in canvas.notes:
-            if note.start_time <= x <= note.end_time and note.name == notes[total_notes - y// note_height - 1]:
-                canvas.remove_note(note)
-                break
+        canvas.flush_motions()
+        x, y = int(canvas.world_x(event.x)), int(event.y + canvas.canvasy(0))
+        note = canvas.note_at(x, y)
+        if note is not None:
+            canvas.remove_note(note)
 
     @staticmethod
+    @profiler.input_handler('right drag')
     def right_click_drag_handler(event):
         canvas = event.widget
-        x, y = int(event.x + canvas.canvasx(0) + canvas.x_offset), int(event.y + canvas.canvasy(0))
+        x, y = int(canvas.world_x(event.x)), int(event.y + canvas.canvasy(0))
 
         # prevent dragging above the top note (out of the window) going out of bounds later
         if y < 0:
@@ -437,10 +1240,78 @@ class NoteEntry(FastCanvas):
         elif y > total_notes * note_height - 1:
             y = total_notes * note_height - 1
 
-        for note in canvas.notes:
-            if note.start_time <= x <= note.end_time and note.name == notes[total_notes - y// note_height - 1]:
-                canvas.remove_note(note)
-                break
+        note = canvas.note_at(x, y)
+        if note is not None:
+            canvas.remove_note(note)
+
+
+
+class Overview(FastCanvas):
+    """The whole song at a glance, below the note canvas.
+
+    Drawn from the same merged spans as the zoomed out note canvas, so it
+    stays cheap for any number of notes. Clicking or dragging scrolls the note canvas there.
+    """
+
+    def __init__(self, parent, note_entry, **kwargs):
+        super().__init__(parent, height=overview_height, borderwidth=0, highlightthickness=0, background=cs.grid_bg_black, **kwargs)
+        self.note_entry = note_entry
+        # (index version, width, extent) the spans were drawn for
+        self.drawn_key = None
+        self.drawn_at = 0.0
+        # (index version, x offset, visible time, width) once up to date
+        self.drawn_view = None
+        self.extent = 1
+        self.view_item = tk.Canvas.create_rectangle(self, 0, 0, 0, 0, outline=cs.note, tags='view')
+
+        self.bind('<Button-1>', self.scroll_to)
+        self.bind('<B1-Motion>', self.scroll_to)
+        self.poll()
+
+    def poll(self):
+        self.refresh()
+        self.after(int(1000 / redraw_rate), self.poll)
+
+    def refresh(self):
+        """Redraws what changed since the last poll, which most of the time is nothing."""
+        note_entry = self.note_entry
+        width = self.winfo_width()
+        view = (note_entry.index.version, note_entry.x_offset, note_entry.visible_time, width)
+        if view == self.drawn_view:
+            return
+        extent = max(note_entry.index.length(), note_entry.x_offset + note_entry.visible_time)
+        key = (note_entry.index.version, width, extent)
+        if key != self.drawn_key and time.perf_counter() - self.drawn_at >= overview_refresh:
+            self.drawn_key = key
+            self.drawn_at = time.perf_counter()
+            self.extent = extent
+            self.draw_spans(width)
+            # the spans are restacked when the frame is sent to Tk, so it
+            # has to be sent before raising the view above them
+            self.end_frame()
+            self.tag_raise(self.view_item)
+        if key == self.drawn_key:
+            # otherwise the spans are throttled, and the next poll tries again
+            self.drawn_view = view
+
+        scale = width / self.extent
+        x0 = note_entry.x_offset * scale
+        self.coords(self.view_item, x0, 0, max(x0 + note_entry.visible_time * scale, x0 + 2), overview_height - 1)
+
+    def draw_spans(self, width):
+        self.invalidate()
+        scale = width / self.extent
+        y_scale = overview_height / (total_notes * note_height)
+        for row, start_time, end_time in self.note_entry.index.spans(0, self.extent, lod_level(scale, lod_gap)):
+            y = row_y[row] * y_scale
+            left = start_time * scale
+            self.create_rectangle(left, y, max(end_time * scale, left + 1), y + max(note_height * y_scale, 1), fill=cs.note, width=0, tags='note')
+
+    def scroll_to(self, event):
+        note_entry = self.note_entry
+        time_x = event.x * self.extent / self.winfo_width()
+        note_entry.x_offset = max(0, round(time_x - note_entry.visible_time / 2))
+        note_entry.request_redraw()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,397 @@
+import heapq
+import itertools
+import math
+import queue
+import threading
+import time
+
+from note import as_store, merged_note_events, open_synth, pcm_bytes, time_scale
+from profiler import profiler
+
+
+# previews asked for this long ago (in seconds) are dropped instead of
+# played, e.g. the ones made while the synth was still loading
+preview_max_delay = 0.1
+
+
+class JitterStats:
+    """How late events were sent compared to their deadlines."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def record(self, lateness):
+        self.count += 1
+        self.total += lateness
+        if lateness > self.worst:
+            self.worst = lateness
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        return f'mean {self.mean * 1000:.3f} ms, max {self.worst * 1000:.3f} ms over {self.count} events'
+
+
+class PlaybackEngine:
+    """Owns the synth and plays notes from a single long-lived thread.
+
+    Everything else talks to it through commands on a queue, so it never
+    has to touch Tk variables. Events are fired against absolute
+    time.monotonic() deadlines, which keeps timing errors from adding up
+    over a long song.
+
+    Without a synth, the engine opens one on its own thread, so starting
+    FluidSynth and loading the soundfont doesn't hold up the window.
+    Commands sent in the meantime wait in the queue.
+
+    A song is played from the merged event streams of its tracks (see
+    merged_note_events), pulled one event at a time, each on its track's
+    channel of the shared synth.
+    """
+
+    def __init__(self, synth=None):
+        self.synth = synth
+        self.commands = queue.Queue()
+        # only written by the playback thread, safe to poll from the GUI
+        self.state = 'Stopped' if synth is not None else 'Loading'
+        self.jitter = JitterStats()
+
+        # (tick, status, value, velocity) iterator of the song, and its next event
+        self.events = iter(())
+        self.next_event = None
+        self.tempo = 120
+        # the song position (in ms at 120 bpm) at anchor_time
+        self.anchor_time = 0.0
+        self.anchor_position = 0.0
+        self.sounding = set()
+
+        # (deadline, sequence number, channel, value) of preview note offs
+        self.previews = []
+        self.preview_counter = itertools.count()
+
+        self.thread = threading.Thread(target=self.run, name='playback', daemon=True)
+        self.thread.start()
+
+    def play(self, notes, tempo):
+        """Plays `notes`, which are turned into events on the playback
+        thread, so pass a NoteSnapshot rather than a store being edited."""
+        self.commands.put(('play', notes, tempo))
+
+    def preview(self, value, duration, tempo, channel=0):
+        """Plays a single note right away, `duration` being in pixels."""
+        self.commands.put(('preview', value, duration, tempo, channel, time.monotonic()))
+
+    def set_programs(self, tracks):
+        """Sets the program of each track's channel."""
+        self.commands.put(('programs', [(track.channel, track.program) for track in tracks]))
+
+    def stop(self):
+        self.commands.put(('stop',))
+
+    def set_tempo(self, tempo):
+        self.commands.put(('tempo', tempo))
+
+    def close(self):
+        self.commands.put(('close',))
+        self.thread.join()
+
+    def now(self):
+        """The engine's clock, in seconds. Deadlines are on this clock."""
+        return time.monotonic()
+
+    def position(self, now=None):
+        """The current song position in ms at 120 bpm."""
+        if now is None:
+            now = self.now()
+        return self.anchor_position + (now - self.anchor_time) * 1000 * self.tempo / 120
+
+    def deadline(self, position):
+        return self.anchor_time + (position - self.anchor_position) / 1000 * 120 / self.tempo
+
+    def next_deadline(self):
+        deadlines = []
+        if self.next_event is not None:
+            deadlines.append(self.deadline(self.next_event[0]))
+        if self.previews:
+            deadlines.append(self.previews[0][0])
+        return min(deadlines, default=None)
+
+    def load_synth(self):
+        started = time.perf_counter()
+        try:
+            self.synth = open_synth()
+        except Exception as e:
+            print(f'Could not open the synth, playback is disabled: {e}')
+            self.state = 'No synth'
+            return
+        print(f'Synth ready in {(time.perf_counter() - started) * 1000:.0f} ms')
+        self.state = 'Stopped'
+
+    def run(self):
+        if self.synth is None:
+            self.load_synth()
+        self.loop()
+
+    def loop(self):
+        while True:
+            deadline = self.next_deadline()
+            try:
+                if deadline is None:
+                    command = self.commands.get()
+                else:
+                    # waits on a lock rather than spinning, which would hold
+                    # the GIL and starve the Tk thread; a wakeup a little early
+                    # fires nothing and just waits again
+                    timeout = deadline - time.monotonic()
+                    if timeout > 0:
+                        command = self.commands.get(timeout=timeout)
+                    else:
+                        command = self.commands.get_nowait()
+            except queue.Empty:
+                command = None
+
+            if command is not None:
+                if command[0] == 'close':
+                    self.stop_song()
+                    return
+                self.handle(command)
+                continue
+
+            self.fire_due_events()
+
+    def handle(self, command):
+        now = self.now()
+        if self.synth is None:
+            return
+
+        if command[0] == 'play':
+            _, notes, tempo = command
+            self.stop_song()
+            notes = as_store(notes)
+            self.change_programs([(track.channel, track.program) for track in notes.tracks])
+            self.events = merged_note_events(notes)
+            self.next_event = next(self.events, None)
+            self.tempo = tempo
+            # the song starts once it's ready, not when it was asked for
+            self.anchor_time = self.now()
+            self.anchor_position = 0.0
+            self.jitter.reset()
+            self.state = 'Playing'
+            if self.next_event is None:
+                self.finish_song()
+        elif command[0] == 'stop':
+            self.stop_song()
+        elif command[0] == 'tempo':
+            # re-anchor, so the song continues from where it is at the new rate
+            self.anchor_position = self.position(now)
+            self.anchor_time = now
+            self.tempo = command[1]
+        elif command[0] == 'programs':
+            self.change_programs(command[1])
+        elif command[0] == 'preview':
+            _, value, duration, tempo, channel, asked_at = command
+            if time.monotonic() - asked_at > preview_max_delay:
+                return
+            end = now + duration * time_scale / 1000 * 120 / tempo
+            self.synth.noteon(channel, value, 90)
+            heapq.heappush(self.previews, (end, next(self.preview_counter), channel, value))
+
+    def change_programs(self, programs):
+        for channel, program in programs:
+            self.synth.program_change(channel, program)
+
+    def fire_due_events(self, now=None):
+        """Sends the events with deadlines up to `now`, by default the current time."""
+        if now is None:
+            now = self.now()
+
+        while self.next_event is not None:
+            tick, status, value, velocity = self.next_event
+            deadline = self.deadline(tick)
+            if deadline > now:
+                break
+            self.jitter.record(now - deadline)
+            profiler.record('playback jitter ms', (now - deadline) * 1000)
+            channel = status & 0x0f
+            if status & 0xf0 == 0x90:
+                self.synth.noteon(channel, value, velocity)
+                self.sounding.add((channel, value))
+            else:
+                self.synth.noteoff(channel, value)
+                self.sounding.discard((channel, value))
+            self.next_event = next(self.events, None)
+            if self.next_event is None:
+                self.finish_song()
+
+        while self.previews and self.previews[0][0] <= now:
+            deadline, _, channel, value = heapq.heappop(self.previews)
+            self.jitter.record(now - deadline)
+            profiler.record('playback jitter ms', (now - deadline) * 1000)
+            self.synth.noteoff(channel, value)
+
+    def stop_song(self):
+        for channel, value in self.sounding:
+            self.synth.noteoff(channel, value)
+        self.sounding.clear()
+        if self.next_event is not None:
+            self.finish_song()
+
+    def finish_song(self):
+        self.events = iter(())
+        self.next_event = None
+        self.state = 'Stopped'
+        print(f'Playback timing jitter: {self.jitter}')
+
+
+class BlockPlaybackEngine(PlaybackEngine):
+    """Plays by rendering audio ahead of the sound card, instead of sending
+    events to the synth in real time.
+
+    The synth runs without an audio driver. The playback thread renders
+    fixed-size blocks with Synth.get_samples, splitting a block wherever an
+    event falls in it, so every event lands on its exact sample. Finished
+    blocks wait in a queue of `lookahead` blocks that the sounddevice
+    callback plays from, so a stall of the thread (or the GUI) shorter than
+    the lookahead can't be heard.
+
+    The engine clock (see now()) is the number of frames rendered, so
+    deadlines and previews work the same as in PlaybackEngine. Without
+    sounddevice, it falls back to playing in real time like PlaybackEngine.
+    """
+
+    def __init__(self, synth=None, samplerate=44100, block_frames=512, lookahead=4):
+        self.samplerate = samplerate
+        self.block_frames = block_frames
+        # (end frame, 16-bit stereo PCM) of rendered blocks not played yet
+        self.blocks = queue.Queue(maxsize=lookahead)
+        self.stream = None
+        self.rendered = 0
+        # first frame of the block being played
+        self.played = 0
+        self.underruns = 0
+        super().__init__(synth)
+
+    def now(self):
+        if self.stream is None:
+            return super().now()
+        return self.rendered / self.samplerate
+
+    def position(self, now=None):
+        # where the song is in what can be heard, not in what was rendered
+        if now is None and self.stream is not None:
+            now = self.played / self.samplerate
+        return super().position(now)
+
+    def load_synth(self):
+        try:
+            import sounddevice
+        except (ImportError, OSError) as e:
+            print(f'No sounddevice, playing in real time instead of in blocks: {e}')
+            super().load_synth()
+            return
+
+        started = time.perf_counter()
+        try:
+            self.synth = open_synth(samplerate=self.samplerate, driver=False)
+            self.stream = sounddevice.RawOutputStream(
+                samplerate=self.samplerate, blocksize=self.block_frames, channels=2, dtype='int16',
+                callback=self.callback)
+        except Exception as e:
+            print(f'Could not open the synth, playback is disabled: {e}')
+            self.synth = None
+            self.state = 'No synth'
+            return
+        print(f'Synth ready in {(time.perf_counter() - started) * 1000:.0f} ms')
+        self.state = 'Stopped'
+
+    def loop(self):
+        if self.stream is None:
+            super().loop()
+            return
+
+        # one block's time: by then the callback has room for another one
+        block_time = self.block_frames / self.samplerate
+        try:
+            self.stream.start()
+            while True:
+                while not self.blocks.full():
+                    self.render_block()
+                try:
+                    command = self.commands.get(timeout=block_time)
+                except queue.Empty:
+                    continue
+                if command[0] == 'close':
+                    self.stop_song()
+                    return
+                if command[0] in ('play', 'stop'):
+                    # start or stop right away, not after the lookahead
+                    self.drop_blocks()
+                self.handle(command)
+                # a play command holds the song's snapshot, which would keep
+                # copying the notes edited while waiting for the next one
+                command = None
+        except Exception as e:
+            # the thread ends here, so say so rather than look stopped
+            print(f'Audio output failed, playback is disabled: {e}')
+            self.state = 'No synth'
+        finally:
+            self.stream.close()
+
+    def render_block(self):
+        """Renders the next block, firing each event due in it at its frame."""
+        end = self.rendered + self.block_frames
+        pieces = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None:
+                break
+            frame = max(math.ceil(deadline * self.samplerate), self.rendered)
+            if frame >= end:
+                break
+            if frame > self.rendered:
+                pieces.append(self.synth.get_samples(frame - self.rendered))
+                self.rendered = frame
+            self.fire_due_events(deadline)
+        pieces.append(self.synth.get_samples(end - self.rendered))
+        self.rendered = end
+        self.blocks.put((end, b''.join(pcm_bytes(piece) for piece in pieces)))
+
+    def drop_blocks(self):
+        while True:
+            try:
+                self.blocks.get_nowait()
+            except queue.Empty:
+                break
+        # the next block heard is the next one rendered; until the callback
+        # takes it, position() would otherwise still count the dropped ones
+        self.played = self.rendered
+
+    def callback(self, outdata, frames, time_info, status):
+        # runs on the audio thread, so it only takes a finished block
+        try:
+            end, pcm = self.blocks.get_nowait()
+        except queue.Empty:
+            outdata[:] = bytes(len(outdata))
+            self.underruns += 1
+            profiler.record('audio underruns', 1)
+            return
+        outdata[:] = pcm
+        self.played = end - frames
+
+
+def engine_from_config(config):
+    """Makes the engine set up in the [Playback] section of config.ini."""
+    section = config['Playback'] if config.has_section('Playback') else {}
+    if section.get('mode', 'blocks') != 'blocks':
+        return PlaybackEngine()
+    return BlockPlaybackEngine(
+        block_frames=int(section.get('block_frames', 512)),
+        lookahead=int(section.get('lookahead', 4)),
+    )
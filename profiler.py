@@ -0,0 +1,184 @@
+import atexit
+import functools
+import os
+import threading
+import time
+import tkinter as tk
+from collections import deque
+
+
+# how often the overlay is refreshed and samples are written to the log, in ms
+refresh_interval = 500
+# the overlay shows the mean and max over this many recent samples
+window_size = 100
+
+
+class CountingTk:
+    """Wraps a widget's Tcl interpreter, counting the calls made through it."""
+
+    def __init__(self, tk):
+        self.tk = tk
+        self.calls = 0
+
+    def call(self, *args):
+        self.calls += 1
+        return self.tk.call(*args)
+
+    def eval(self, script):
+        self.calls += 1
+        return self.tk.eval(script)
+
+    def __getattr__(self, name):
+        return getattr(self.tk, name)
+
+
+class Stat:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.recent = deque(maxlen=window_size)
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.worst:
+            self.worst = value
+        self.recent.append(value)
+
+    def __str__(self):
+        recent = list(self.recent)
+        return f'{sum(recent) / len(recent):.2f} avg, {max(recent):.2f} max'
+
+
+class Profiler:
+    """Collects timings and Tcl call counts while profiling is switched on.
+
+    Values are kept per metric name, durations in ms. Everything is a no-op
+    (apart from checking `enabled`) while profiling is off, so the hooks can
+    stay in the drawing and playback code.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.overlay = False
+        self.log_path = None
+        self.stats = {}
+        # (time, name, value) not written to the log yet
+        self.samples = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.overlay_item = None
+
+    def configure(self, config):
+        """Reads the [Profiling] section of config.ini.
+
+        The PIANO_PROFILE environment variable, when set, overrides
+        whether profiling is enabled.
+        """
+        section = config['Profiling'] if config.has_section('Profiling') else {}
+        enabled = os.environ.get('PIANO_PROFILE', section.get('enabled', 'no'))
+        self.enabled = enabled.lower() in ('1', 'yes', 'true', 'on')
+        self.overlay = section.get('overlay', 'yes').lower() in ('1', 'yes', 'true', 'on')
+        self.log_path = section.get('log_file') or None
+        if self.enabled and self.log_path:
+            atexit.register(self.write_log)
+
+    def record(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = Stat()
+            stat.record(value)
+            if self.log_path:
+                self.samples.append((time.perf_counter() - self.started, name, value))
+
+    def counting(self, tk):
+        """Returns a wrapper around a Tcl interpreter that counts calls."""
+        return CountingTk(tk)
+
+    def timed(self, name):
+        """Decorator recording how long each call takes, and the Tcl calls it
+        makes when the first argument is a widget with a counting interpreter."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(widget, *args, **kwargs):
+                if not self.enabled:
+                    return func(widget, *args, **kwargs)
+                calls = getattr(widget.tk, 'calls', 0)
+                started = time.perf_counter()
+                try:
+                    return func(widget, *args, **kwargs)
+                finally:
+                    self.record(f'{name} ms', (time.perf_counter() - started) * 1000)
+                    if hasattr(widget.tk, 'calls'):
+                        self.record(f'{name} tcl calls', widget.tk.calls - calls)
+            return wrapper
+        return decorator
+
+    def input_handler(self, name):
+        """Decorator for event handlers, recording the time from the event
+        arriving to the canvas having been redrawn.
+
+        Events deferred to a later frame carry the time they arrived in
+        `queued_at`, otherwise the handler is assumed to run right away.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(event):
+                if not self.enabled:
+                    return func(event)
+                started = getattr(event, 'queued_at', None) or time.perf_counter()
+                try:
+                    return func(event)
+                finally:
+                    self.after_redraw(event.widget, lambda: self.record(f'{name} latency ms', (time.perf_counter() - started) * 1000))
+            return wrapper
+        return decorator
+
+    def after_redraw(self, widget, callback):
+        # Tk redraws a canvas from an idle callback, and idle callbacks added
+        # while idle callbacks are being run wait for the next round. The
+        # redraw is queued by the changes this handler (or the pending
+        # FastCanvas flush) makes, so going through two rounds lands after it.
+        widget.after_idle(lambda: widget.after_idle(callback))
+
+    def start(self, canvas):
+        """Starts refreshing the overlay on `canvas` and writing the log."""
+        if self.enabled:
+            self.refresh(canvas)
+
+    def refresh(self, canvas):
+        if self.overlay:
+            self.draw_overlay(canvas)
+        self.write_log()
+        canvas.after(refresh_interval, self.refresh, canvas)
+
+    def overlay_text(self):
+        with self.lock:
+            return '\n'.join(f'{name}: {stat}' for name, stat in sorted(self.stats.items()))
+
+    def draw_overlay(self, canvas):
+        # drawn straight onto the canvas, not through the FastCanvas pool
+        x, y = canvas.canvasx(4), canvas.canvasy(4)
+        if self.overlay_item is None:
+            self.overlay_item = tk.Canvas.create_text(canvas, x, y, anchor='nw', fill='#ffffff', font=('TkFixedFont', 8), tags='profile_overlay')
+        canvas.coords(self.overlay_item, x, y)
+        canvas.itemconfigure(self.overlay_item, text=self.overlay_text())
+        canvas.tag_raise(self.overlay_item)
+
+    def write_log(self):
+        """Appends the samples recorded since the last write to the log file,
+        one tab-separated (seconds since start, metric, value) line each."""
+        if not self.log_path:
+            return
+        with self.lock:
+            samples, self.samples = self.samples, []
+        if samples:
+            with open(self.log_path, 'a') as f:
+                f.writelines(f'{t:.6f}\t{name}\t{value:.6g}\n' for t, name, value in samples)
+
+
+profiler = Profiler()
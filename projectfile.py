@@ -0,0 +1,197 @@
+import mmap
+import pickle
+import struct
+import sys
+import uuid
+
+from note import Note, NoteStore, Track, as_store
+
+
+magic = b'PNOT'
+version = 2
+# magic, version, record size, note count, a reserved field, track count
+# (always 0 in version 1). The reserved field held the longest note
+# duration, which nothing reads any more; it's written as 0.
+header_format = struct.Struct('<4sHHQII')
+# start time, end time, MIDI value, velocity, track
+record_format = struct.Struct('<iiBBBx')
+# the track table after the records: channel, program, velocity, name
+# length, then the name in UTF-8, for each track
+track_format = struct.Struct('<BBBB')
+
+
+class NotesFileError(Exception):
+    pass
+
+
+class NotesFile:
+    """A binary .notes file, opened through mmap.
+
+    Opening only reads the header and track table, so it's near-instant
+    even for a huge project. Records are sorted by start time and decoded
+    a chunk at a time (see chunks()), so the notes at the start of the
+    song can be shown while the rest is still loading.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            self.file.close()
+            raise NotesFileError(f'{path} is not a .notes file')
+
+        if len(self.map) < header_format.size:
+            self.close()
+            raise NotesFileError(f'{path} is not a .notes file')
+        file_magic, file_version, record_size, count, _, n_tracks = header_format.unpack_from(self.map)
+        if file_magic != magic:
+            self.close()
+            raise NotesFileError(f'{path} is not a .notes file')
+        if file_version > version:
+            self.close()
+            raise NotesFileError(f'{path} was written by a newer version (format {file_version})')
+        if record_size < record_format.size:
+            # records can only grow, with new fields at the end
+            self.close()
+            raise NotesFileError(f'{path} is damaged (records of {record_size} bytes, at least {record_format.size} expected)')
+
+        self.record_size = record_size
+        self.count = count
+        self.n_tracks = n_tracks
+        # (channel, program, velocity, name) of each track, read up front
+        # so a truncated file fails here rather than while loading
+        try:
+            self.track_table = self.read_track_table()
+        except (struct.error, NotesFileError):
+            self.close()
+            raise NotesFileError(f'{path} is truncated or damaged')
+
+    def read_track_table(self):
+        offset = header_format.size + self.count * self.record_size
+        if offset > len(self.map):
+            raise NotesFileError('records past the end of the file')
+        table = []
+        for _ in range(self.n_tracks):
+            channel, program, velocity, name_length = track_format.unpack_from(self.map, offset)
+            offset += track_format.size
+            if offset + name_length > len(self.map):
+                raise NotesFileError('track name past the end of the file')
+            name = self.map[offset:offset + name_length].decode('utf-8', 'replace')
+            offset += name_length
+            table.append((channel, program, velocity, name))
+        return table
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """Returns record i as (start_time, end_time, value, velocity, track)."""
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return record_format.unpack_from(self.map, header_format.size + i * self.record_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if not self.map.closed:
+            self.map.close()
+        self.file.close()
+
+    def tracks(self):
+        """Returns the list of Tracks the records refer to."""
+        if not self.track_table:
+            return [Track('Track 1')]
+        return [Track(name, channel, program, velocity) for channel, program, velocity, name in self.track_table]
+
+    def chunks(self, size=1 << 15):
+        """Yields lists of records, `size` at a time."""
+        for first in range(0, self.count, size):
+            n = min(size, self.count - first)
+            offset = header_format.size + first * self.record_size
+            if self.record_size == record_format.size:
+                data = self.map[offset:offset + n * self.record_size]
+                yield list(record_format.iter_unpack(data))
+            else:
+                yield [record_format.unpack_from(self.map, offset + i * self.record_size) for i in range(n)]
+
+    def to_store(self):
+        store = NoteStore(tracks=self.tracks())
+        for chunk in self.chunks():
+            store.extend_records(chunk)
+        return store
+
+
+def write_notes_file(path, notes):
+    """Writes a NoteStore (or a NoteSnapshot, or a list of Notes) as a binary .notes file."""
+    notes = as_store(notes)
+
+    ids = sorted(notes.ids(), key=notes.start.__getitem__)
+
+    with open(path, 'wb') as f:
+        f.write(header_format.pack(magic, version, record_format.size, len(ids), 0, len(notes.tracks)))
+        chunk = bytearray()
+        for note_id in ids:
+            chunk += record_format.pack(notes.start[note_id], notes.end[note_id], notes.pitch[note_id], notes.velocity[note_id], notes.track[note_id])
+            if len(chunk) >= 1 << 16:
+                f.write(chunk)
+                chunk = bytearray()
+        for track in notes.tracks:
+            name = track.name.encode('utf-8')[:255]
+            chunk += track_format.pack(track.channel, track.program, track.velocity, len(name)) + name
+        f.write(chunk)
+
+
+def is_pickle_file(path):
+    with open(path, 'rb') as f:
+        return f.read(1) == b'\x80'
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    """Reads the old pickled .notes files, which are lists of Note.
+
+    Only the classes such a file can contain are allowed, so a shared file
+    can't run arbitrary code when loaded.
+    """
+    allowed = {
+        ('note', 'Note'): Note,
+        ('uuid', 'UUID'): uuid.UUID,
+        ('uuid', 'SafeUUID'): uuid.SafeUUID,
+    }
+
+    def find_class(self, module, name):
+        try:
+            return self.allowed[module, name]
+        except KeyError:
+            raise pickle.UnpicklingError(f'{module}.{name} is not allowed in a .notes file')
+
+
+def read_pickle_file(path):
+    with open(path, 'rb') as f:
+        try:
+            return NoteStore(LegacyUnpickler(f).load())
+        except (pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError, ValueError) as e:
+            # a disallowed class, a truncated file, or not a list of notes
+            # with known names
+            raise NotesFileError(f"{path} isn't a valid old .notes file: {e}")
+
+
+def convert_pickle_file(path, new_path=None):
+    """Converts an old pickled .notes file to the binary format, in place by default."""
+    store = read_pickle_file(path)
+    write_notes_file(new_path or path, store)
+    return store
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        if is_pickle_file(path):
+            store = convert_pickle_file(path)
+            print(f'Converted {path} ({len(store)} notes)')
+        else:
+            print(f'Skipped {path}, not a pickled .notes file')
@@ -0,0 +1,169 @@
+import os
+import time
+import wave
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import fluidsynth
+
+from note import as_store, notes_to_messages, pcm_bytes, soundfont_path
+
+
+samplerate = 44100
+channels = 2
+# frames asked from the synth at a time
+block_frames = 65536
+# how long notes are left to ring out after their note off, in seconds
+release_time = 2.0
+# segments handed to worker processes are at least this long, in seconds
+segment_time = 30.0
+
+
+def event_timeline(messages, tempo, samplerate=samplerate):
+    """Converts messages to a sorted list of (frame, on or off, value, velocity, channel)."""
+    frames_per_ms = samplerate / 1000 * 120 / tempo
+    events = [(round(t * frames_per_ms), kind, value, velocity, channel) for t, kind, value, velocity, channel in messages]
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def split_segments(events, min_frames):
+    """Splits the timeline into segments that can be rendered independently.
+
+    Segments are only cut where no note is sounding, so each one starts
+    from a silent synth, exactly like a continuous render would.
+    """
+    segments = []
+    first = 0
+    sounding = 0
+    for i, event in enumerate(events):
+        sounding += 1 if event[1] == 'note_on' else -1
+        last_at_frame = i + 1 == len(events) or events[i + 1][0] != event[0]
+        if sounding <= 0 and last_at_frame and event[0] - events[first][0] >= min_frames:
+            segments.append(events[first:i + 1])
+            first = i + 1
+            sounding = 0
+    if first < len(events):
+        segments.append(events[first:])
+    return segments
+
+
+def render_frames(synth, n_frames):
+    chunks = []
+    while n_frames > 0:
+        n = min(n_frames, block_frames)
+        chunks.append(pcm_bytes(synth.get_samples(n)))
+        n_frames -= n
+    return b''.join(chunks)
+
+
+def render_segment(job):
+    """Renders one segment without an audio driver. Runs in a worker process.
+
+    Returns 16-bit stereo PCM starting at the segment's first event.
+    """
+    events, programs, soundfont, samplerate = job
+    synth = fluidsynth.Synth(samplerate=float(samplerate))
+    sfid = synth.sfload(soundfont)
+    synth.program_select(0, sfid, 0, 0)
+    for channel, program in programs:
+        synth.program_change(channel, program)
+
+    start = events[0][0]
+    position = start
+    pcm = bytearray()
+    for frame, kind, value, velocity, channel in events:
+        if frame > position:
+            pcm += render_frames(synth, frame - position)
+            position = frame
+        if kind == 'note_on':
+            synth.noteon(channel, value, velocity)
+        else:
+            synth.noteoff(channel, value)
+    pcm += render_frames(synth, int(release_time * samplerate))
+
+    synth.delete()
+    return start, bytes(pcm)
+
+
+def mix_into(dest, src, start):
+    """Adds the samples of `src` into `dest` from index `start`, clipping."""
+    for i, sample in enumerate(src[:len(dest) - start]):
+        mixed = dest[start + i] + sample
+        dest[start + i] = max(-32768, min(32767, mixed))
+    dest.extend(src[len(dest) - start:])
+
+
+class PCMWriter:
+    """Writes raw PCM, or a WAV file when the path ends in .wav."""
+
+    def __init__(self, path, samplerate):
+        self.is_wav = path.lower().endswith('.wav')
+        if self.is_wav:
+            self.file = wave.open(path, 'wb')
+            self.file.setnchannels(channels)
+            self.file.setsampwidth(2)
+            self.file.setframerate(samplerate)
+        else:
+            self.file = open(path, 'wb')
+
+    def write(self, samples):
+        if self.is_wav:
+            self.file.writeframesraw(samples)
+        else:
+            self.file.write(samples)
+
+    def close(self):
+        self.file.close()
+
+
+def render_to_file(notes, tempo, path, soundfont=soundfont_path, samplerate=samplerate, workers=None):
+    """Renders notes offline to a WAV (or raw 16-bit stereo PCM) file.
+
+    Long songs are split into segments at silent points and rendered in
+    parallel worker processes, then stitched back together in order.
+    With `workers=1`, everything is rendered in this process.
+    Returns the length of the rendered audio in seconds.
+    """
+    started = time.perf_counter()
+    notes = as_store(notes)
+    events = event_timeline(notes_to_messages(notes), tempo, samplerate)
+    segments = split_segments(events, int(segment_time * samplerate))
+    programs = [(track.channel, track.program) for track in notes.tracks]
+    jobs = [(segment, programs, os.path.abspath(soundfont), samplerate) for segment in segments]
+
+    if len(jobs) > 1 and workers != 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(render_segment, jobs)
+    else:
+        executor = None
+        results = map(render_segment, jobs)
+
+    writer = PCMWriter(path, samplerate)
+    # samples rendered but not written yet, starting at frame `written`
+    pending = array('h')
+    written = 0
+    try:
+        for start, pcm in results:
+            samples = array('h')
+            samples.frombytes(pcm)
+            # everything before this segment is final
+            ready = max(0, min(len(pending), (start - written) * channels))
+            writer.write(pending[:ready].tobytes())
+            written += ready // channels
+            del pending[:ready]
+            if start > written:
+                # silence between segments
+                writer.write(bytes((start - written) * channels * 2))
+                written = start
+            mix_into(pending, samples, (start - written) * channels)
+        writer.write(pending.tobytes())
+        written += len(pending) // channels
+    finally:
+        writer.close()
+        if executor is not None:
+            executor.shutdown()
+
+    seconds = written / samplerate
+    print(f'Rendered {seconds:.1f} s of audio in {time.perf_counter() - started:.1f} s')
+    return seconds